@@ -1,5 +1,6 @@
 from utils import PValue
 from process import Process
+from pvalueset import PValueSet
 from message import P1aMessage,P1bMessage,P2aMessage,P2bMessage
 
 class Acceptor(Process):
@@ -8,12 +9,13 @@ class Acceptor(Process):
     reply to p1a and p2a messages received from leaders. The Acceptor
     state consists of two variables:
     - ballot_number: a ballot number, initially None.
-    - accepted: a set of pvalues, initially empty.
+    - accepted: a set of pvalues, initially empty. Only the pvalue
+    with the highest ballot number is kept for every slot.
     """
     def __init__(self, env, id):
         Process.__init__(self, env, id)
         self.ballot_number = None
-        self.accepted = set()
+        self.accepted = PValueSet()
         self.env.addProc(self)
 
     def body(self):
@@ -40,7 +42,10 @@ class Acceptor(Process):
             if isinstance(msg, P1aMessage):
                 if msg.ballot_number > self.ballot_number:
                     self.ballot_number = msg.ballot_number
-                self.sendMessage(msg.src, P1bMessage(self.id, self.ballot_number, self.accepted))
+                # Send a copy: the scout reads it while this acceptor
+                # keeps accepting.
+                accepted = self.accepted.range(1)
+                self.sendMessage(msg.src, P1bMessage(self.id, self.ballot_number, accepted))
             elif isinstance(msg, P2aMessage):
                 if msg.ballot_number == self.ballot_number:
                     self.accepted.add(PValue(msg.ballot_number,msg.slot_number,msg.command))
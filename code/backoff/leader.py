@@ -1,9 +1,11 @@
+import time
+import unittest as ut
 from utils import *
 from process import Process
 from commander import Commander
 from scout import Scout
 from message import ProposeMessage, AdoptedMessage, PreemptedMessage
-from time import sleep
+from timer import Scheduler
 
 class Leader(Process):
     """
@@ -14,7 +16,8 @@ class Leader(Process):
     - proposals: a map of slot numbers to proposed commands in the form
     of a set of (slot number, command) pairs, initially empty. At any
     time, there is at most one entry per slot number in the set.
-    - timeout: time in seconds the leader waits between operations
+    - timeout: time in seconds the leader waits after being preempted
+    before it tries to get a new ballot adopted
     """
     def __init__(self, env, id, config):
         Process.__init__(self, env, id)
@@ -22,9 +25,19 @@ class Leader(Process):
         self.active = False
         self.proposals = {}
         self.timeout = 1.0
+        self.timer = Scheduler()
+        self.relaunch = None
         self.config = config
         self.env.addProc(self)
 
+    def scout(self):
+        """
+        Spawns a scout to get the current ballot number adopted.
+        """
+        self.relaunch = None
+        Scout(self.env, "scout:%s:%s" % (str(self.id), str(self.ballot_number)),
+              self.id, self.config.acceptors, self.ballot_number)
+
     def body(self):
         """
         The leader starts by spawning a scout for its initial ballot
@@ -45,13 +58,18 @@ class Leader(Process):
         included in the message. If this ballot number is higher than
         the current ballot number of the leader, it may no longer be
         possible to use the current ballot number to choose a command.
+        The leader then waits timeout seconds before it spawns a scout
+        for a higher ballot number, which damps livelock between
+        competing leaders. It keeps handling messages while it waits.
         """
         print("Here I am: ", self.id)
-        Scout(self.env, "scout:%s:%s" % (str(self.id), str(self.ballot_number)),
-                    self.id, self.config.acceptors, self.ballot_number)
+        self.scout()
         while True:
-            msg = self.getNextMessage()
-            if isinstance(msg, ProposeMessage):
+            msg = self.getNextMessage(self.timer.timeout())
+            self.timer.run()
+            if msg is None:
+                pass
+            elif isinstance(msg, ProposeMessage):
                 if msg.slot_number not in self.proposals:
                     self.proposals[msg.slot_number] = msg.command
                     if self.active:
@@ -67,14 +85,10 @@ class Leader(Process):
                     self.timeout = self.timeout - TIMEOUTSUBTRACT
                     print(self.id, "Timeout decreased: ", self.timeout)
                 if self.ballot_number == msg.ballot_number:
-                    pmax = {}
                     # For every slot number add the proposal with
                     # the highest ballot number to proposals
                     for pv in msg.accepted:
-                        if pv.slot_number not in pmax or \
-                              pmax[pv.slot_number] < pv.ballot_number:
-                            pmax[pv.slot_number] = pv.ballot_number
-                            self.proposals[pv.slot_number] = pv.command
+                        self.proposals[pv.slot_number] = pv.command
                     # Start a commander (i.e. run Phase 2) for every
                     # proposal (from the beginning)
                     for sn in self.proposals:
@@ -95,10 +109,67 @@ class Leader(Process):
                     self.active = False
                     self.ballot_number = BallotNumber(msg.ballot_number.round+1,
                                                       self.id)
-                    Scout(self.env, "scout:%s:%s" % (str(self.id),
-                                                     str(self.ballot_number)),
-                          self.id, self.config.acceptors, self.ballot_number)
-
+                    if self.relaunch is None:
+                        self.relaunch = self.timer.schedule(self.timeout,
+                                                            self.scout)
             else:
                 print("Leader: unknown msg type")
-            sleep(self.timeout)
+
+
+class test_leader(ut.TestCase):
+    class Env:
+        """
+        Runs the leader on its own thread but keeps the scouts it
+        spawns, with the time each one was created, instead of running
+        them.
+        """
+        def __init__(self):
+            import queue
+            self.procs = {}
+            self.scouts = queue.SimpleQueue()
+
+        def addProc(self, proc):
+            if isinstance(proc, Scout):
+                self.scouts.put((time.monotonic(), proc.ballot_number))
+            else:
+                self.procs[proc.id] = proc
+
+        def sendMessage(self, dst, msg):
+            pass
+
+    def test_backoff(self):
+        """
+        A preempted leader relaunches its scout after its timeout,
+        which grows when a leader with priority preempted it and
+        shrinks again once its ballot is adopted.
+        """
+        import io, contextlib
+        from pvalueset import PValueSet
+        env = self.Env()
+        with contextlib.redirect_stdout(io.StringIO()):
+            leader = Leader(env, "leader 0", Config([], ["acceptor 0"], []))
+            leader.timeout = 0.1
+            leader.daemon = True
+            leader.start()
+            self.assertEqual(env.scouts.get(timeout=5)[1],
+                             BallotNumber(0, "leader 0"))
+            preempted = time.monotonic()
+            leader.deliver(PreemptedMessage("scout",
+                                            BallotNumber(1, "leader 1")))
+            relaunched, ballot_number = env.scouts.get(timeout=5)
+            self.assertGreaterEqual(relaunched - preempted,
+                                    0.1 * TIMEOUTMULTIPLY)
+            self.assertEqual(ballot_number, BallotNumber(2, "leader 0"))
+            leader.deliver(AdoptedMessage("scout", ballot_number,
+                                          PValueSet()))
+            for i in range(500):
+                if leader.active:
+                    break
+                time.sleep(0.01)
+        self.assertTrue(leader.active)
+        self.assertAlmostEqual(leader.timeout,
+                               0.1 * TIMEOUTMULTIPLY - TIMEOUTSUBTRACT)
+        self.assertTrue(env.scouts.empty())
+
+if __name__ == "__main__":
+    ut.main()
@@ -1,14 +1,33 @@
 import multiprocessing
+import queue
 from threading import Thread
 
+def local_inbox():
+    """
+    Inbox for processes that share one OS process: a plain in-memory
+    queue without any serialization.
+    """
+    return queue.SimpleQueue()
+
+def manager_inbox():
+    """
+    Inbox proxied through a multiprocessing Manager server. Every
+    message is pickled and every inbox runs its own server process, so
+    this is only worth it when messages cross OS process boundaries.
+    """
+    return multiprocessing.Manager().Queue()
+
 class Process(Thread):
     """
     A process is a thread with a queue of incoming messages, and an
-    "environment" that keeps track of all processes and queues.
+    "environment" that keeps track of all processes and queues. The
+    kind of queue is selected by inbox_factory.
     """
+    inbox_factory = staticmethod(local_inbox)
+
     def __init__(self, env, id):
         super(Process, self).__init__()
-        self.inbox = multiprocessing.Manager().Queue()
+        self.inbox = self.inbox_factory()
         self.env = env
         self.id = id
 
@@ -19,8 +38,15 @@ class Process(Thread):
         except EOFError:
             print("Exiting..")
 
-    def getNextMessage(self):
-        return self.inbox.get()
+    def getNextMessage(self, timeout=None):
+        """
+        Returns the next message, or None if no message arrives within
+        timeout seconds.
+        """
+        try:
+            return self.inbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
 
     def sendMessage(self, dst, msg):
         self.env.sendMessage(dst, msg)
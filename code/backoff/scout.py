@@ -1,4 +1,5 @@
 from process import Process
+from pvalueset import PValueSet
 from message import P1aMessage, P1bMessage, PreemptedMessage, AdoptedMessage
 
 class Scout(Process):
@@ -39,7 +40,7 @@ class Scout(Process):
             self.sendMessage(a, P1aMessage(self.id, self.ballot_number))
             waitfor.add(a)
 
-        pvalues = set()
+        pvalues = PValueSet()
         while True:
             msg = self.getNextMessage()
             if isinstance(msg, P1bMessage):
@@ -0,0 +1,65 @@
+import heapq
+import itertools
+import time
+
+class Timer:
+    """
+    A callback scheduled to run at a given time. A cancelled timer
+    stays in the scheduler's heap until its time comes, but does not
+    run.
+    """
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    """
+    Scheduler keeps the timers of one process in a heap ordered by
+    time. It runs no thread of its own: the process asks it how long it
+    may block waiting for a message, and calls run() after every wait
+    to fire the timers that are due. This way a process can delay an
+    action without delaying the messages it handles meanwhile.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+
+    def schedule(self, delay, callback, *args):
+        """
+        Runs callback(*args) once delay seconds have passed, and
+        returns the Timer, which can be cancelled.
+        """
+        timer = Timer(self.clock() + delay, callback, args)
+        # The counter keeps timers due at the same time in order and
+        # spares comparing Timer objects.
+        heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+        return timer
+
+    def timeout(self):
+        """
+        Returns the number of seconds until the next timer is due, or
+        None if no timer is pending.
+        """
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - self.clock())
+
+    def run(self):
+        """
+        Runs the callbacks of all timers that are due.
+        """
+        now = self.clock()
+        while self.heap and self.heap[0][0] <= now:
+            timer = heapq.heappop(self.heap)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
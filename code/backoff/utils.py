@@ -13,6 +13,13 @@ class BallotNumber(namedtuple('BallotNumber',['round','leader_id'])):
     def __str__(self):
         return "BN(%d,%s)" % (self.round, str(self.leader_id))
 
+    def __gt__(self, other):
+        # Every ballot number exceeds None, the initial ballot number
+        # of an acceptor.
+        if other is None:
+            return True
+        return super().__gt__(other)
+
 class PValue(namedtuple('PValue',['ballot_number','slot_number','command'])):
     """
     PValue is a triple consisting of a ballot number, a slot number, a command.
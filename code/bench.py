@@ -0,0 +1,494 @@
+"""
+Benchmarks for the Paxos variants in this directory. Every run loads
+one variant (initial, backoff or state-reduction), builds a cluster in
+a single process and reports how fast it makes progress:
+
+  $ python bench.py initial decisions --requests 200
+  $ python bench.py initial decisions --requests 200 --inbox manager
+  $ python bench.py initial decisions --requests 200 --logdir /tmp/paxos
+  $ python bench.py initial decisions --requests 2000 --runtime async
+  $ python bench.py initial decisions --requests 2000 --leaders 3 --pool 0
+  $ python bench.py initial perform --decisions 1000000
+  $ python bench.py state-reduction pvalues --slots 100000
+  $ python bench.py initial codec --messages 20000
+  $ python bench.py backoff load --clients 50 --duration 10
+  $ python bench.py initial load --rate 2000 --leaders 2
+  $ python bench.py initial sim --seed 3 --crash 0.5 --victim 1
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+
+def load(variant):
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), variant)
+  if not os.path.isdir(path):
+    sys.exit("unknown variant: %s" % variant)
+  sys.path.insert(0, path)
+
+def fresh(path):
+  """
+  Removes the log at path, so a benchmark starts from an empty cluster.
+  """
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  elif os.path.exists(path):
+    os.remove(path)
+  return path
+
+def cluster(env, nreplicas, nacceptors, nleaders, logdir=None):
+  from acceptor import Acceptor
+  from leader import Leader
+  from replica import Replica
+  from utils import Config
+  try:
+    from registry import register
+  except ImportError:
+    # Variants without a registry use the names as process ids.
+    register = str
+
+  config = Config([], [], [])
+  replicas = []
+  for i in range(nreplicas):
+    pid = register("replica %d" % i)
+    config.replicas.append(pid)
+    if logdir is None:
+      replicas.append(Replica(env, pid, config))
+    else:
+      path = fresh(os.path.join(logdir, "replica_%d.log" % i))
+      replicas.append(Replica(env, pid, config, logdir=path))
+  for i in range(nacceptors):
+    pid = register("acceptor %d" % i)
+    if logdir is None:
+      Acceptor(env, pid)
+    else:
+      Acceptor(env, pid, fresh(os.path.join(logdir, "acceptor_%d.wal" % i)))
+    config.acceptors.append(pid)
+  for i in range(nleaders):
+    pid = register("leader %d" % i)
+    Leader(env, pid, config)
+    config.leaders.append(pid)
+  return config, replicas
+
+def environment(args):
+  """
+  Returns the Env class to run the cluster with: one thread per
+  process, or one event loop for all of them.
+  """
+  from env import Env
+  if args.runtime == "thread":
+    return Env
+  if getattr(args, "logdir", None):
+    sys.exit("--logdir needs --runtime thread: fsync would block the loop")
+  try:
+    from asyncenv import AsyncEnv
+  except ImportError:
+    sys.exit("%s has no asyncio runtime" % args.variant)
+  return AsyncEnv
+
+def committed(msg):
+  """
+  Returns the client commands decided by msg if it is a decision, so
+  that benchmarks can follow progress in every variant.
+  """
+  from message import DecisionMessage
+  if not isinstance(msg, DecisionMessage):
+    return ()
+  if hasattr(msg.command, "commands"):
+    return msg.command.commands
+  return (msg.command,)
+
+def bench_decisions(args):
+  """
+  Submits args.requests client commands at once, spreading them over
+  the replicas, and measures the time until all of them are decided.
+  """
+  import process
+  from message import RequestMessage
+  from utils import Command
+
+  Env = environment(args)
+  class CountingEnv(Env):
+    if args.pool is not None:
+      poolsize = args.pool or None
+
+    def __init__(self):
+      Env.__init__(self)
+      self.decided = set()
+
+    def sendMessage(self, dst, msg):
+      self.decided.update(committed(msg))
+      Env.sendMessage(self, dst, msg)
+
+  if args.inbox == "manager":
+    process.Process.inbox_factory = staticmethod(process.manager_inbox)
+  env = CountingEnv()
+  config, replicas = cluster(env, args.replicas, args.acceptors, args.leaders,
+                             args.logdir)
+
+  start = time.time()
+  for i in range(args.requests):
+    pid = "client %d" % i
+    r = config.replicas[i % len(config.replicas)]
+    env.sendMessage(r, RequestMessage(pid, Command(pid, 0, "operation %d" % i)))
+  deadline = start + args.timeout
+  threads = threading.active_count()
+  while time.time() < deadline and len(env.decided) < args.requests:
+    time.sleep(0.01)
+    threads = max(threads, threading.active_count())
+  elapsed = time.time() - start
+  done = len(env.decided)
+  slots = max(r.slot_out for r in replicas) - 1
+  print("runtime=%s inbox=%s decisions=%d slots=%d elapsed=%.2fs "
+        "decisions/sec=%.1f threads=%d" %
+        (args.runtime, args.inbox, done, slots, elapsed, done / elapsed,
+         threads))
+
+def percentile(latencies, q):
+  return latencies[min(len(latencies)-1, int(q * len(latencies)))]
+
+def bench_load(args):
+  """
+  Runs a workload for args.duration seconds and reports the throughput
+  and the commit latency: the time from sending a request to a replica
+  until the first decision that contains it. Requests sent during the
+  first args.warmup seconds are not counted.
+
+  In closed-loop mode each of args.clients clients has one request
+  outstanding and sends the next as soon as it is decided. With
+  args.rate, requests arrive at that rate on average no matter how
+  many are outstanding (open loop), spread over the clients.
+  """
+  from message import RequestMessage
+  from utils import Command
+
+  Env = environment(args)
+  class LoadEnv(Env):
+    def __init__(self):
+      Env.__init__(self)
+      self.lock = threading.Lock()
+      self.sent = {}     # (client, req_id) -> time sent
+      self.latencies = []
+      self.closed = args.rate is None
+      self.issuing = True
+
+    def request(self, client, req_id):
+      pid = "client %d" % client
+      cmd = Command(pid, req_id, "operation %d.%d" % (client, req_id))
+      with self.lock:
+        self.sent[(pid, req_id)] = time.time()
+      Env.sendMessage(self, config.replicas[client % len(config.replicas)],
+                      RequestMessage(pid, cmd))
+
+    def sendMessage(self, dst, msg):
+      for cmd in committed(msg):
+        now = time.time()
+        with self.lock:
+          sent = self.sent.pop((cmd.client, cmd.req_id), None)
+          if sent is not None and warmup <= sent and now <= end:
+            self.latencies.append(now - sent)
+        if sent is not None and self.closed and self.issuing:
+          self.request(int(cmd.client.split()[1]), cmd.req_id+1)
+      Env.sendMessage(self, dst, msg)
+
+  env = LoadEnv()
+  stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+  config, replicas = cluster(env, args.replicas, args.acceptors, args.leaders)
+  start = time.time()
+  warmup = start + args.warmup
+  end = warmup + args.duration
+  if env.closed:
+    for c in range(args.clients):
+      env.request(c, 0)
+    time.sleep(end - time.time())
+  else:
+    next_id = [0] * args.clients
+    due = start
+    n = 0
+    while due < end:
+      due += random.expovariate(args.rate)
+      time.sleep(max(0, due - time.time()))
+      env.request(n % args.clients, next_id[n % args.clients])
+      next_id[n % args.clients] += 1
+      n += 1
+  env.issuing = False
+  # The replicas keep printing, so stdout stays silenced and the report
+  # goes to the real one.
+  with env.lock:
+    latencies = sorted(env.latencies)
+  mode = "closed" if env.closed else "open rate=%d/s" % args.rate
+  if not latencies:
+    print("%s %s: no requests decided" % (args.variant, mode), file=stdout)
+    return
+  print("%s %s %s clients=%d replicas=%d acceptors=%d leaders=%d: "
+        "%.1f ops/s p50=%.2fms p99=%.2fms p999=%.2fms" %
+        (args.variant, args.runtime, mode, args.clients, args.replicas,
+         args.acceptors,
+         args.leaders, len(latencies) / args.duration,
+         percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3,
+         percentile(latencies, 0.999) * 1e3), file=stdout)
+  stdout.flush()
+
+def bench_sim(args):
+  """
+  Runs args.requests client commands through a cluster in the
+  deterministic simulator, optionally crashing leader args.victim at
+  args.crash seconds of simulated time, and reports how far the cluster got in
+  args.duration simulated seconds and how long that took in real time.
+  Runs with the same seed and the same PYTHONHASHSEED print the same
+  digest of the decisions.
+  """
+  import hashlib
+  from message import RequestMessage
+  from sim import SimEnv
+  from utils import Command
+
+  class TracingEnv(SimEnv):
+    def __init__(self):
+      SimEnv.__init__(self, args.seed, args.latency, args.jitter, args.drop)
+      self.decided = []
+      self.seen = set()
+
+    def sendMessage(self, dst, msg):
+      for cmd in committed(msg):
+        if (cmd.client, cmd.req_id) not in self.seen:
+          self.seen.add((cmd.client, cmd.req_id))
+          self.decided.append(cmd)
+      SimEnv.sendMessage(self, dst, msg)
+
+  env = TracingEnv()
+  stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+  config, replicas = cluster(env, args.replicas, args.acceptors, args.leaders)
+  for i in range(args.requests):
+    pid = "client %d" % (i % 10)
+    cmd = Command(pid, i // 10, "operation %d" % i)
+    env.at(i * args.interval, env.sendMessage,
+           config.replicas[i % len(config.replicas)], RequestMessage(pid, cmd))
+  if args.crash is not None:
+    env.at(args.crash, env.crash, config.leaders[args.victim])
+  start = time.time()
+  events = env.run(until=args.duration)
+  elapsed = time.time() - start
+  sys.stdout = stdout
+  digest = hashlib.sha1(repr([(c.client, c.req_id) for c in env.decided])
+                        .encode()).hexdigest()[:12]
+  print("seed=%d decided=%d/%d slots=%d simulated=%.2fs elapsed=%.2fs "
+        "events=%d (%.0f/s) messages sent=%d delivered=%d dropped=%d "
+        "digest=%s" %
+        (args.seed, len(env.decided), args.requests,
+         max(r.slot_out for r in replicas) - 1, env.now, elapsed, events,
+         events / elapsed, env.sent, env.delivered, env.dropped, digest))
+
+def bench_perform(args):
+  """
+  Feeds args.decisions decisions straight into Replica.perform, without
+  any threads, and reports the cost per slot for every tenth of the
+  run. A flat profile means duplicate detection does not depend on
+  the length of the log.
+  """
+  from replica import Replica
+  from utils import Command, Config
+
+  class NullEnv:
+    def addProc(self, proc):
+      pass
+
+  replica = Replica(NullEnv(), "replica 0", Config([], [], []))
+  step = max(1, args.decisions // 10)
+  stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+  costs = []
+  start = time.time()
+  for slot in range(1, args.decisions+1):
+    # Every tenth decision repeats an earlier command.
+    n = slot - 1 if slot % 10 else slot // 2
+    cmd = Command("client %d" % (n % args.clients), n // args.clients,
+                  "operation %d" % n)
+    replica.decisions[slot] = cmd
+    replica.perform(cmd)
+    if slot % step == 0:
+      now = time.time()
+      costs.append((slot, (now - start) / step))
+      start = now
+  sys.stdout = stdout
+  for slot, cost in costs:
+    print("slots up to %8d: %6.2f us/slot" % (slot, cost * 1e6))
+
+def bench_pvalues(args):
+  """
+  Compares a PValueSet with a plain set of pvalues as acceptor state:
+  the memory of an acceptor that accepted args.slots slots in each of
+  args.ballots ballots, and the time for a scout to merge the P1b
+  replies of args.acceptors such acceptors and for its leader to pick
+  the pvalue with the highest ballot number for every slot.
+  """
+  import tracemalloc
+  from pvalueset import PValueSet
+  from utils import BallotNumber, PValue
+
+  def accepted():
+    for b in range(args.ballots):
+      ballot_number = BallotNumber(b, "leader 0")
+      for s in range(1, args.slots+1):
+        yield PValue(ballot_number, s, "operation %d" % s)
+
+  def measure(make):
+    tracemalloc.start()
+    state = make(accepted())
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return state, size
+
+  def merge_set(replies):
+    pvalues = set()
+    for reply in replies:
+      pvalues.update(reply)
+    pmax, proposals = {}, {}
+    for pv in pvalues:
+      if pv.slot_number not in pmax or pmax[pv.slot_number] < pv.ballot_number:
+        pmax[pv.slot_number] = pv.ballot_number
+        proposals[pv.slot_number] = pv.command
+    return proposals
+
+  def merge_pvalueset(replies):
+    pvalues = PValueSet()
+    for reply in replies:
+      pvalues.update(reply)
+    return dict((pv.slot_number, pv.command) for pv in pvalues)
+
+  for name, make, merge in (("set", set, merge_set),
+                            ("PValueSet", PValueSet, merge_pvalueset)):
+    state, size = measure(make)
+    start = time.time()
+    proposals = merge(args.acceptors * [state])
+    elapsed = time.time() - start
+    assert len(proposals) == args.slots
+    print("%-9s pvalues=%8d memory=%8.1f MB merge=%7.1f ms" %
+          (name, len(state), size / 1e6, elapsed * 1e3))
+
+def bench_codec(args):
+  """
+  Compares the wire codec with pickle on typical messages: the encoded
+  size and the time to encode and decode each. The codec keeps one
+  Encoder and Decoder for the whole run, as a connection does.
+  """
+  import pickle
+  from codec import Encoder, Decoder
+  from message import (P1bMessage, P2aBatchMessage, P2bBatchMessage,
+                       P2bMessage, DecisionMessage, RequestMessage)
+  from pvalueset import PValueSet
+  from utils import BallotNumber, BatchCommand, Command, PValue
+
+  b = BallotNumber(3, "leader 0")
+  cmds = [Command("client %d" % i, 12345, "operation %d" % i)
+          for i in range(16)]
+  batch = BatchCommand(tuple(cmds))
+  messages = [
+    ("Request", RequestMessage("client 1", cmds[1])),
+    ("P2aBatch", P2aBatchMessage("commander:leader 0:BN(3,leader 0)", b,
+                                 [(100000+i, c) for i, c in enumerate(cmds)])),
+    ("P2b", P2bMessage("acceptor 0", b, 100000)),
+    ("P2bBatch", P2bBatchMessage("acceptor 0", b, list(range(100000, 100016)))),
+    ("Decision", DecisionMessage("commander:leader 0:BN(3,leader 0)",
+                                 100000, batch)),
+    ("P1b", P1bMessage("acceptor 0", b,
+                       PValueSet(PValue(b, 100000+i, c)
+                                 for i, c in enumerate(cmds * 64)))),
+  ]
+  n = args.messages
+  for name, msg in messages:
+    encoder, decoder = Encoder(), Decoder()
+    # Intern the ids first, as earlier messages on a connection would.
+    decoder.decode(encoder.encode(msg))
+    results = []
+    for encode, decode in (
+        (lambda m: pickle.dumps(m, pickle.HIGHEST_PROTOCOL), pickle.loads),
+        (encoder.encode, decoder.decode)):
+      start = time.time()
+      for i in range(n):
+        data = encode(msg)
+      encoded = time.time() - start
+      start = time.time()
+      for i in range(n):
+        decode(data)
+      decoded = time.time() - start
+      results.append((len(data), encoded / n * 1e6, decoded / n * 1e6))
+    print("%-8s pickle: %6d bytes %7.1f us enc %7.1f us dec | "
+          "codec: %6d bytes %7.1f us enc %7.1f us dec" %
+          ((name,) + results[0] + results[1]))
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("variant")
+  sub = parser.add_subparsers(dest="bench", required=True)
+
+  p = sub.add_parser("decisions", help="end-to-end decisions per second")
+  p.add_argument("--requests", type=int, default=200)
+  p.add_argument("--replicas", type=int, default=2)
+  p.add_argument("--acceptors", type=int, default=3)
+  p.add_argument("--leaders", type=int, default=1)
+  p.add_argument("--inbox", choices=["local", "manager"], default="local")
+  p.add_argument("--logdir", help="log acceptor and replica state here")
+  p.add_argument("--timeout", type=float, default=60.0)
+  p.add_argument("--runtime", choices=["thread", "async"], default="thread")
+  p.add_argument("--pool", type=int,
+                  help="threads for scouts and commanders, 0 for one each")
+  p.set_defaults(func=bench_decisions)
+
+  p = sub.add_parser("load", help="throughput and commit latency under load")
+  p.add_argument("--clients", type=int, default=10)
+  p.add_argument("--rate", type=float,
+                 help="requests per second (open loop); closed loop if unset")
+  p.add_argument("--replicas", type=int, default=2)
+  p.add_argument("--acceptors", type=int, default=3)
+  p.add_argument("--leaders", type=int, default=1)
+  p.add_argument("--warmup", type=float, default=2.0)
+  p.add_argument("--duration", type=float, default=10.0)
+  p.add_argument("--runtime", choices=["thread", "async"], default="thread")
+  p.set_defaults(func=bench_load)
+
+  p = sub.add_parser("sim", help="a cluster in the deterministic simulator")
+  p.add_argument("--requests", type=int, default=1000)
+  p.add_argument("--interval", type=float, default=0.001,
+                 help="simulated seconds between requests")
+  p.add_argument("--replicas", type=int, default=2)
+  p.add_argument("--acceptors", type=int, default=3)
+  p.add_argument("--leaders", type=int, default=2)
+  p.add_argument("--seed", type=int, default=0)
+  p.add_argument("--latency", type=float, default=0.001)
+  p.add_argument("--jitter", type=float, default=0.001)
+  p.add_argument("--drop", type=float, default=0.0)
+  p.add_argument("--crash", type=float,
+                 help="simulated time at which to crash a leader")
+  p.add_argument("--victim", type=int, default=0,
+                 help="index of the leader to crash")
+  p.add_argument("--duration", type=float, default=10.0)
+  p.set_defaults(func=bench_sim)
+
+  p = sub.add_parser("perform", help="cost of Replica.perform over a long log")
+  p.add_argument("--decisions", type=int, default=1000000)
+  p.add_argument("--clients", type=int, default=100)
+  p.set_defaults(func=bench_perform)
+
+  p = sub.add_parser("pvalues", help="PValueSet against a plain set")
+  p.add_argument("--slots", type=int, default=100000)
+  p.add_argument("--ballots", type=int, default=5)
+  p.add_argument("--acceptors", type=int, default=3)
+  p.set_defaults(func=bench_pvalues)
+
+  p = sub.add_parser("codec", help="wire codec against pickle")
+  p.add_argument("--messages", type=int, default=20000)
+  p.set_defaults(func=bench_codec)
+
+  args = parser.parse_args()
+  load(args.variant)
+  args.func(args)
+  sys.stdout.flush()
+  # Paxos processes never exit on their own.
+  os._exit(0)
+
+if __name__ == "__main__":
+  main()
@@ -1,31 +1,111 @@
-from utils import PValue
+from utils import PValue,GROUPCOMMIT,LEASE
 from process import Process
+from pvalueset import PValueSet
+from wal import AcceptorLog
+import registry
 from message import P1aMessage,P1bMessage,P2aMessage,P2bMessage
+from message import P2aBatchMessage,P2bBatchMessage,CheckpointMessage
+from message import LeaseMessage,LeaseGrantMessage
 
 class Acceptor(Process):
-  def __init__(self, env, id):
+  def __init__(self, env, id, logpath=None):
     Process.__init__(self, env, id)
     self.ballot_number = None
-    self.accepted = set()
+    self.accepted = PValueSet()
+    self.checkpoint = 0
+    # With a log, the state survives restarts and no reply leaves
+    # before the state it reports is on disk.
+    self.log = None
+    if logpath is not None:
+      self.log = AcceptorLog(logpath)
+      self.ballot_number, self.accepted, self.checkpoint = self.log.recover()
+    # While the leader of ballot_number holds a lease, this acceptor
+    # promises no ballot of another leader, so the leader can serve
+    # reads without asking. A restarted acceptor does not know how
+    # long the lease still runs, and assumes a full one.
+    self.lease_holder = None
+    self.lease_expiry = 0
+    if self.ballot_number is not None:
+      self.lease_holder = self.ballot_number.leader_id
+      self.lease_expiry = self.clock() + LEASE
+    self.replies = []
     self.env.addProc(self)
 
-  def body(self):
-    print("Here I am: ", self.id)
+  def reply(self, dst, msg):
+    self.replies.append((dst, msg))
+
+  async def body(self):
+    print("Here I am: ", registry.name(self.id))
     while True:
-      msg = self.getNextMessage()
-      if isinstance(msg, P1aMessage):
-        if msg.ballot_number > self.ballot_number:
-          self.ballot_number = msg.ballot_number
-        self.sendMessage(msg.src,
-                         P1bMessage(self.id,
-                                    self.ballot_number,
-                                    self.accepted))
-      elif isinstance(msg, P2aMessage):
-        if msg.ballot_number == self.ballot_number:
-          self.accepted.add(PValue(msg.ballot_number,
-                                   msg.slot_number,
-                                   msg.command))
-        self.sendMessage(msg.src,
-                         P2bMessage(self.id,
-                                    self.ballot_number,
-                                    msg.slot_number))
+      # Handle every message that is already waiting, then make all of
+      # their state changes durable with one fsync before replying.
+      msg = await self.getNextMessage()
+      n = 0
+      while msg is not None:
+        self.handle(msg)
+        n += 1
+        msg = await self.getNextMessage(0) if n < GROUPCOMMIT else None
+      if self.log is not None:
+        self.log.sync()
+      for dst, msg in self.replies:
+        self.sendMessage(dst, msg)
+      self.replies = []
+
+  def accept(self, pvalue):
+    self.accepted.add(pvalue)
+    if self.log is not None:
+      self.log.accept(pvalue)
+
+  def promise(self, ballot_number):
+    if ballot_number.leader_id != self.lease_holder and \
+          self.clock() < self.lease_expiry:
+      return
+    if ballot_number > self.ballot_number:
+      self.ballot_number = ballot_number
+      if self.log is not None:
+        self.log.promise(self.ballot_number)
+
+  def handle(self, msg):
+    if isinstance(msg, P1aMessage):
+      self.promise(msg.ballot_number)
+      self.reply(msg.src,
+                 P1bMessage(self.id,
+                            self.ballot_number,
+                            self.accepted.range(msg.slot_number)))
+    elif isinstance(msg, P2aMessage):
+      # A P2a for a higher ballot implies its P1a, which this acceptor
+      # may have missed, e.g. because it started after the scout ran.
+      self.promise(msg.ballot_number)
+      if msg.ballot_number == self.ballot_number:
+        self.accept(PValue(msg.ballot_number,
+                           msg.slot_number,
+                           msg.command))
+      self.reply(msg.src,
+                 P2bMessage(self.id,
+                            self.ballot_number,
+                            msg.slot_number))
+    elif isinstance(msg, P2aBatchMessage):
+      self.promise(msg.ballot_number)
+      if msg.ballot_number == self.ballot_number:
+        for slot_number, command in msg.proposals:
+          self.accept(PValue(msg.ballot_number,
+                             slot_number,
+                             command))
+      self.reply(msg.src,
+                 P2bBatchMessage(self.id,
+                                 self.ballot_number,
+                                 [s for s, c in msg.proposals]))
+    elif isinstance(msg, LeaseMessage):
+      if msg.ballot_number == self.ballot_number:
+        self.lease_holder = msg.ballot_number.leader_id
+        self.lease_expiry = self.clock() + LEASE
+        self.reply(msg.src, LeaseGrantMessage(self.id, msg.ballot_number,
+                                              msg.lease_id))
+    elif isinstance(msg, CheckpointMessage):
+      # All replicas have checkpointed these slots, so no leader will
+      # need their pvalues again.
+      if msg.slot_number > self.checkpoint:
+        self.checkpoint = msg.slot_number
+        self.accepted.truncate(self.checkpoint+1)
+        if self.log is not None:
+          self.log.rewrite(self.ballot_number, self.accepted, self.checkpoint)
@@ -0,0 +1,177 @@
+import asyncio
+import threading
+import traceback
+import unittest as ut
+from collections import deque
+from env import Env
+
+class AsyncInbox:
+  """
+  The inbox of a process run by an AsyncEnv. Messages from other
+  threads, such as those of a transport or of the application using a
+  client, are handed over to the event loop.
+  """
+  def __init__(self, env):
+    self.env = env
+    self.messages = deque()
+    self.waiter = None # future the body waits on while there are none
+
+  def put(self, msg):
+    if threading.get_ident() == self.env.thread:
+      self.arrive(msg)
+    else:
+      self.env.loop.call_soon_threadsafe(self.arrive, msg)
+
+  def arrive(self, msg):
+    self.messages.append(msg)
+    if self.waiter is not None and not self.waiter.done():
+      self.waiter.set_result(None)
+
+  async def get(self, timeout):
+    # Returns None if no message arrives within timeout seconds.
+    if not self.messages:
+      if timeout is not None and timeout <= 0:
+        return None
+      loop = self.env.loop
+      self.waiter = loop.create_future()
+      timer = None
+      if timeout is not None:
+        timer = loop.call_later(timeout, self.expire, self.waiter)
+      await self.waiter
+      self.waiter = None
+      if timer is not None:
+        timer.cancel()
+      if not self.messages:
+        return None
+    return self.messages.popleft()
+
+  def expire(self, waiter):
+    if not waiter.done():
+      waiter.set_result(None)
+
+class AsyncEnv(Env):
+  """
+  Runs the bodies of all processes as tasks on one event loop, in a
+  thread of its own, rather than each on its own thread. Starting a
+  scout or commander then costs a task instead of a thread, and a
+  process waiting for messages costs no more than its coroutine.
+
+  Only one process runs at a time, so a body must not block. Writing
+  a log to disk blocks on fsync, so processes with a log are refused.
+  To use more cores, run an AsyncEnv in every process of launch.py.
+  """
+  def __init__(self, nodes=None, node=0):
+    self.loop = asyncio.new_event_loop()
+    started = threading.Event()
+    def run():
+      self.thread = threading.get_ident()
+      asyncio.set_event_loop(self.loop)
+      started.set()
+      self.loop.run_forever()
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    Env.__init__(self, nodes, node)
+
+  def addProc(self, proc):
+    if getattr(proc, "log", None) is not None:
+      raise ValueError("%s logs to disk, which would block the event loop"
+                       % proc.id)
+    proc.inbox = AsyncInbox(self)
+    self.procs[proc.id] = proc
+    if threading.get_ident() == self.thread:
+      self.loop.create_task(self.drive(proc))
+    else:
+      self.loop.call_soon_threadsafe(self.loop.create_task, self.drive(proc))
+
+  async def drive(self, proc):
+    # Runs the body of proc like Process.run(), but awaits its messages.
+    inbox = proc.inbox
+    body = proc.body()
+    try:
+      receive = body.send(None)
+      while True:
+        receive = body.send(await inbox.get(receive.timeout))
+    except StopIteration:
+      pass
+    except Exception:
+      # A failing body takes only its own process down.
+      traceback.print_exc()
+    self.removeProc(proc.id)
+
+
+class test_asyncenv(ut.TestCase):
+  def test_cluster(self):
+    import io, contextlib
+    from acceptor import Acceptor
+    from client import Client
+    from leader import Leader
+    from replica import Replica
+    from utils import Config
+    threads = threading.active_count()
+    env = AsyncEnv()
+    config = Config([], [], [])
+    with contextlib.redirect_stdout(io.StringIO()):
+      replicas = [Replica(env, "replica %d" % i, config) for i in range(2)]
+      config.replicas.extend(r.id for r in replicas)
+      for i in range(3):
+        config.acceptors.append(Acceptor(env, "acceptor %d" % i).id)
+      for i in range(2):
+        config.leaders.append(Leader(env, "leader %d" % i, config).id)
+      client = Client(env, "client", config.replicas)
+      futures = [client.submit(("put", "k", i)) for i in range(100)]
+      results = [f.result(timeout=10) for f in futures]
+      # The puts are concurrent, so they may be ordered any way. Each
+      # one returns the value of the one before, except the last.
+      last = set(range(100)) - set(results)
+      self.assertEqual(len(last), 1)
+      self.assertEqual(client.call(("get", "k"), read=True), last.pop())
+    self.assertEqual(results.count(None), 1)
+    # Only the event loop runs processes.
+    self.assertEqual(threading.active_count(), threads+1)
+
+  def test_reads_without_leases(self):
+    # Reads go through the log when no leader can give a read index.
+    import io, contextlib
+    from acceptor import Acceptor
+    from client import Client
+    from leader import Leader
+    from replica import Replica
+    from utils import Config
+    env = AsyncEnv()
+    config = Config([], [], [])
+    with contextlib.redirect_stdout(io.StringIO()):
+      replicas = [Replica(env, "replica %d" % i, config) for i in range(2)]
+      config.replicas.extend(r.id for r in replicas)
+      for i in range(3):
+        config.acceptors.append(Acceptor(env, "acceptor %d" % i).id)
+      config.leaders.append(Leader(env, "leader 0", config, leases=False).id)
+      client = Client(env, "client", config.replicas)
+      client.call(("put", "k", 1))
+      self.assertEqual(client.submit(("get", "k"), read=True).result(5), 1)
+      self.assertEqual(client.submit(("get", "k"), read=True).result(5), 1)
+
+  def test_failing_body(self):
+    # A body that raises is removed; one with a log is not started.
+    import io, contextlib
+    from process import Process
+    class Failing(Process):
+      async def body(self):
+        await self.getNextMessage()
+        raise RuntimeError("failing")
+    env = AsyncEnv()
+    proc = Failing(env, "failing")
+    env.addProc(proc)
+    with contextlib.redirect_stderr(io.StringIO()) as err:
+      proc.deliver("message")
+      for i in range(100):
+        if "failing" not in env.procs:
+          break
+        threading.Event().wait(0.01)
+    self.assertNotIn("failing", env.procs)
+    self.assertIn("RuntimeError", err.getvalue())
+    logged = Failing(env, "logged")
+    logged.log = "a log on disk"
+    self.assertRaises(ValueError, env.addProc, logged)
+
+if __name__ == "__main__":
+  ut.main()
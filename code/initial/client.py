@@ -0,0 +1,92 @@
+from collections import deque
+from concurrent.futures import Future
+from process import Process
+from message import RequestMessage,ReadMessage,ResponseMessage
+from timer import Scheduler
+from utils import Command,CLIENTWINDOW,CLIENTTIMEOUT
+
+class Submit:
+  # An operation handed to the client by another thread
+  __slots__ = ('op', 'read', 'future')
+
+  def __init__(self, op, read, future):
+    self.op = op
+    self.read = read
+    self.future = future
+
+class Client(Process):
+  """
+  Submits operations to the replicas on behalf of an application and
+  returns their results. Up to window requests are outstanding at a
+  time; any more wait their turn. Responses are matched to requests
+  by req_id. A request that is not answered within timeout seconds is
+  sent again, to the next replica. Replicas perform a command only
+  once, however often it is sent.
+
+  Writes are numbered 0, 1, 2, ... and reads -1, -2, ..., so reads do
+  not leave gaps in the req_ids replicas keep track of.
+  """
+  def __init__(self, env, id, replicas, window=CLIENTWINDOW,
+               timeout=CLIENTTIMEOUT):
+    Process.__init__(self, env, id)
+    self.replicas = replicas
+    self.window = window
+    self.timeout = timeout
+    self.next_write = 0
+    self.next_read = -1
+    self.waiting = deque()
+    self.outstanding = {} # req_id -> (message, future, retry timer)
+    self.timer = Scheduler(self.clock)
+    self.env.addProc(self)
+
+  def submit(self, op, read=False):
+    """
+    Returns a Future for the result of op. Operations that only read
+    the state can be sent as reads, which are not ordered by Paxos.
+    """
+    future = Future()
+    self.deliver(Submit(op, read, future))
+    return future
+
+  def call(self, op, read=False):
+    return self.submit(op, read).result()
+
+  def send(self, req_id, msg, attempt):
+    replica = self.replicas[(abs(req_id) + attempt) % len(self.replicas)]
+    self.sendMessage(replica, msg)
+    future = self.outstanding[req_id][1]
+    retry = self.timer.schedule(self.timeout, self.send, req_id, msg,
+                                attempt+1)
+    self.outstanding[req_id] = (msg, future, retry)
+
+  def start_next(self):
+    while self.waiting and len(self.outstanding) < self.window:
+      submit = self.waiting.popleft()
+      if submit.read:
+        req_id = self.next_read
+        self.next_read -= 1
+        msg = ReadMessage(self.id, Command(self.id, req_id, submit.op))
+      else:
+        req_id = self.next_write
+        self.next_write += 1
+        msg = RequestMessage(self.id, Command(self.id, req_id, submit.op))
+      self.outstanding[req_id] = (msg, submit.future, None)
+      self.send(req_id, msg, 0)
+
+  async def body(self):
+    while True:
+      msg = await self.getNextMessage(self.timer.timeout())
+      self.timer.run()
+      if msg is None:
+        pass
+      elif isinstance(msg, Submit):
+        self.waiting.append(msg)
+      elif isinstance(msg, ResponseMessage):
+        # Every replica answers, so most responses are duplicates.
+        if msg.req_id in self.outstanding:
+          future, retry = self.outstanding.pop(msg.req_id)[1:]
+          retry.cancel()
+          future.set_result(msg.result)
+      else:
+        print("Client: unknown msg type")
+      self.start_next()
@@ -0,0 +1,383 @@
+import io
+import pickle
+import struct
+import sys
+import unittest as ut
+from message import *
+from pvalueset import PValueSet
+from utils import *
+
+VERSION = 1         # Version of the wire format, first byte of a message
+MAXINTERNED = 65536 # Number of strings a connection interns at most
+
+HEADER = struct.Struct("!BB") # version, message type
+
+# Every message type is encoded as its type number and its fields in
+# the order its constructor takes them. Messages of any other type are
+# pickled.
+PICKLED = 0
+MESSAGES = [
+  (P1aMessage, ("pid", "ballot", "uint")),
+  (P1bMessage, ("pid", "ballot", "pvalues")),
+  (P2aMessage, ("pid", "ballot", "uint", "command")),
+  (P2bMessage, ("pid", "ballot", "uint")),
+  (P2aBatchMessage, ("pid", "ballot", "proposals")),
+  (P2bBatchMessage, ("pid", "ballot", "slots")),
+  (PreemptedMessage, ("pid", "ballot")),
+  (AdoptedMessage, ("pid", "ballot", "pvalues")),
+  (DecisionMessage, ("pid", "uint", "command")),
+  (CheckpointMessage, ("pid", "uint")),
+  (CatchupMessage, ("pid", "uint")),
+  (RequestMessage, ("pid", "command")),
+  (ProposeMessage, ("pid", "uint", "command")),
+  (HeartbeatMessage, ("pid", "ballot")),
+  (LeaseMessage, ("pid", "ballot", "uint")),
+  (LeaseGrantMessage, ("pid", "ballot", "uint")),
+  (ReadMessage, ("pid", "command")),
+  (ReadIndexMessage, ("pid", "uint")),
+  (ReadIndexReplyMessage, ("pid", "uint", "uint")),
+  (ResponseMessage, ("pid", "int", "value")),
+  (ReadRejectMessage, ("pid", "uint")),
+]
+TYPES = {cls: (n+1, fields) for n, (cls, fields) in enumerate(MESSAGES)}
+
+# Classes a pickle from another node may name. pickle calls whatever
+# the bytes name, so anyone who can connect to a node could otherwise
+# run code on it.
+PICKLEMODULES = ("message", "utils", "pvalueset")
+PICKLEBUILTINS = {"bool", "bytearray", "bytes", "complex", "dict", "float",
+                  "frozenset", "int", "list", "range", "set", "slice", "str",
+                  "tuple"}
+
+class Unpickler(pickle.Unpickler):
+  def find_class(self, module, name):
+    if module == "builtins" and name in PICKLEBUILTINS or \
+          module in PICKLEMODULES and \
+          isinstance(getattr(sys.modules.get(module), name, None), type):
+      return pickle.Unpickler.find_class(self, module, name)
+    raise pickle.UnpicklingError("%s.%s may not be unpickled" % (module, name))
+
+def unpickle(data):
+  return Unpickler(io.BytesIO(data)).load()
+
+# Tags of the kinds of commands and of other values
+NOCOMMAND, COMMAND, BATCH, RECONFIG, OTHER = range(5)
+NOVALUE, INT, STR, PICKLEDVALUE = range(4)
+
+class Encoder:
+  """
+  Turns messages into bytes. Integer process ids are sent as numbers.
+  Other ids, such as client names, are interned: the first time one is
+  sent it goes out in full and is given the next number, and after
+  that only the number is sent. Numbers and lengths are varints,
+  so small slot numbers and rounds take a single byte.
+
+  An Encoder and the Decoder at the other end must see the same
+  messages in the same order, as they do on a single connection.
+  """
+  def __init__(self):
+    self.interned = {} # string -> number
+    self.buf = bytearray()
+
+  def encode(self, msg, dst=None):
+    """
+    Returns the encoding of msg, preceded by the process id dst if
+    given.
+    """
+    self.buf = bytearray()
+    if dst is not None:
+      self.pid(dst)
+    if type(msg) in TYPES:
+      n, fields = TYPES[type(msg)]
+      self.buf += HEADER.pack(VERSION, n)
+      for kind, value in zip(fields, msg.fields()):
+        getattr(self, kind)(value)
+    else:
+      self.buf += HEADER.pack(VERSION, PICKLED)
+      self.buf += pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+    return bytes(self.buf)
+
+  def uint(self, n):
+    if n < 0x80:
+      self.buf.append(n)
+      return
+    while n >= 0x80:
+      self.buf.append((n & 0x7f) | 0x80)
+      n >>= 7
+    self.buf.append(n)
+
+  def int(self, n):
+    # Zigzag, so that small negative numbers stay small too
+    self.uint(n << 1 if n >= 0 else (-n << 1) - 1)
+
+  def value(self, v):
+    t = type(v)
+    if v is None:
+      self.buf.append(NOVALUE)
+    elif t is int:
+      self.buf.append(INT)
+      self.int(v)
+    elif t is str:
+      self.buf.append(STR)
+      self.str(v)
+    else:
+      self.buf.append(PICKLEDVALUE)
+      data = pickle.dumps(v, pickle.HIGHEST_PROTOCOL)
+      self.uint(len(data))
+      self.buf += data
+
+  def str(self, s):
+    data = s.encode()
+    self.uint(len(data))
+    self.buf += data
+
+  def pid(self, s):
+    # An odd number is an integer pid from the registry. Otherwise 0
+    # means a string follows, and 2n the nth string interned.
+    if type(s) is int:
+      self.uint(s << 1 | 1)
+      return
+    n = self.interned.get(s)
+    if n is not None:
+      self.uint(n << 1)
+      return
+    self.uint(0)
+    self.str(s)
+    if len(self.interned) < MAXINTERNED:
+      self.interned[s] = len(self.interned)+1
+
+  def ballot(self, b):
+    # Round 0 stands for no ballot at all.
+    if b is None:
+      self.uint(0)
+    else:
+      self.uint(b.round+1)
+      self.pid(b.leader_id)
+
+  def command(self, c):
+    t = type(c)
+    if c is None:
+      self.buf.append(NOCOMMAND)
+    elif t is Command and type(c.op) is str and type(c.req_id) is int and \
+          c.req_id >= 0:
+      self.buf.append(COMMAND)
+      self.pid(c.client)
+      self.uint(c.req_id)
+      self.str(c.op)
+    elif t is BatchCommand:
+      self.buf.append(BATCH)
+      self.uint(len(c.commands))
+      for cmd in c.commands:
+        self.command(cmd)
+    elif t is ReconfigCommand and type(c.req_id) is int:
+      self.buf.append(RECONFIG)
+      self.pid(c.client)
+      self.uint(c.req_id)
+      self.str(c.config)
+    else:
+      self.buf.append(OTHER)
+      data = pickle.dumps(c, pickle.HIGHEST_PROTOCOL)
+      self.uint(len(data))
+      self.buf += data
+
+  def pvalues(self, pvalues):
+    # Sorted by slot, so each slot is sent as the gap from the last one.
+    self.uint(len(pvalues))
+    last = 0
+    for pv in sorted(pvalues, key=lambda pv: pv.slot_number):
+      self.ballot(pv.ballot_number)
+      self.uint(pv.slot_number - last)
+      self.command(pv.command)
+      last = pv.slot_number
+
+  def proposals(self, proposals):
+    self.uint(len(proposals))
+    for s, c in proposals:
+      self.uint(s)
+      self.command(c)
+
+  def slots(self, slots):
+    self.uint(len(slots))
+    for s in slots:
+      self.uint(s)
+
+class Decoder:
+  """
+  Turns the bytes made by an Encoder back into messages. What was
+  pickled may only be made of plain builtin values and the classes
+  of the message, utils and pvalueset modules; anything else raises
+  pickle.UnpicklingError.
+  """
+  def __init__(self):
+    self.interned = []
+    self.data = b""
+    self.pos = 0
+
+  def decode(self, data, dst=False):
+    """
+    Returns the message in data, or (dst, message) if the encoding
+    starts with a process id.
+    """
+    self.data = data
+    self.pos = 0
+    if dst:
+      dst = self.pid()
+    version, n = HEADER.unpack_from(data, self.pos)
+    if version != VERSION:
+      raise ValueError("unsupported wire format version %d" % version)
+    self.pos += HEADER.size
+    if n == PICKLED:
+      msg = unpickle(data[self.pos:])
+    else:
+      cls, fields = MESSAGES[n-1]
+      msg = cls(*[getattr(self, kind)() for kind in fields])
+    if dst is False:
+      return msg
+    return dst, msg
+
+  def uint(self):
+    b = self.data[self.pos]
+    self.pos += 1
+    if b < 0x80:
+      return b
+    n, shift = b & 0x7f, 7
+    while True:
+      b = self.data[self.pos]
+      self.pos += 1
+      n |= (b & 0x7f) << shift
+      if b < 0x80:
+        return n
+      shift += 7
+
+  def int(self):
+    n = self.uint()
+    return n >> 1 if n & 1 == 0 else -((n+1) >> 1)
+
+  def value(self):
+    tag = self.data[self.pos]
+    self.pos += 1
+    if tag == NOVALUE:
+      return None
+    if tag == INT:
+      return self.int()
+    if tag == STR:
+      return self.str()
+    n = self.uint()
+    v = unpickle(self.data[self.pos:self.pos+n])
+    self.pos += n
+    return v
+
+  def str(self):
+    n = self.uint()
+    s = str(self.data[self.pos:self.pos+n], "utf-8")
+    self.pos += n
+    return s
+
+  def pid(self):
+    n = self.uint()
+    if n & 1:
+      return n >> 1
+    if n > 0:
+      return self.interned[(n >> 1)-1]
+    s = self.str()
+    if len(self.interned) < MAXINTERNED:
+      self.interned.append(s)
+    return s
+
+  def ballot(self):
+    r = self.uint()
+    if r == 0:
+      return None
+    return BallotNumber(r-1, self.pid())
+
+  def command(self):
+    tag = self.data[self.pos]
+    self.pos += 1
+    if tag == NOCOMMAND:
+      return None
+    if tag == COMMAND:
+      return Command(self.pid(), self.uint(), self.str())
+    if tag == BATCH:
+      return BatchCommand(tuple(self.command() for i in range(self.uint())))
+    if tag == RECONFIG:
+      return ReconfigCommand(self.pid(), self.uint(), self.str())
+    n = self.uint()
+    c = unpickle(self.data[self.pos:self.pos+n])
+    self.pos += n
+    return c
+
+  def pvalues(self):
+    result = PValueSet()
+    last = 0
+    for i in range(self.uint()):
+      b = self.ballot()
+      last += self.uint()
+      result.add(PValue(b, last, self.command()))
+    return result
+
+  def proposals(self):
+    return [(self.uint(), self.command()) for i in range(self.uint())]
+
+  def slots(self):
+    return [self.uint() for i in range(self.uint())]
+
+
+class test_codec(ut.TestCase):
+  def roundtrip(self, msg):
+    return Decoder().decode(Encoder().encode(msg))
+
+  def test_messages(self):
+    b = BallotNumber(3, "leader 0")
+    cmd = Command("client 1", 7, "operation 1")
+    batch = BatchCommand((cmd, Command("client 2", 300, "operation 2")))
+    accepted = PValueSet([PValue(b, 1, cmd), PValue(b, 200, batch)])
+    for msg in [P1aMessage("scout", b, 5),
+                P2aMessage("commander", b, 1000000, batch),
+                P2aBatchMessage("commander", b, [(1, cmd), (2, batch)]),
+                P2bBatchMessage("acceptor 0", b, [1, 2, 3]),
+                DecisionMessage("commander", 9, ReconfigCommand("m", 0, "a;b;c")),
+                RequestMessage("client 1", Command("c", 0, ("not", "a", "str"))),
+                ReadMessage("client 1", Command("c", -5, ("get", "k"))),
+                ResponseMessage("replica 0", -300, -1),
+                ResponseMessage("replica 0", 7, "value"),
+                ResponseMessage("replica 0", 8, ("a", 1)),
+                ResponseMessage("replica 0", 9, None)]:
+      decoded = self.roundtrip(msg)
+      self.assertIs(type(decoded), type(msg))
+      self.assertEqual(decoded.fields(), msg.fields())
+    decoded = self.roundtrip(P1bMessage("acceptor 0", b, accepted))
+    self.assertEqual(sorted(decoded.accepted), sorted(accepted))
+    decoded = self.roundtrip(AdoptedMessage("scout", None, PValueSet()))
+    self.assertIsNone(decoded.ballot_number)
+    self.assertEqual(len(decoded.accepted), 0)
+
+  def test_interning(self):
+    encoder, decoder = Encoder(), Decoder()
+    msg = P2bMessage("acceptor 0", BallotNumber(1, "leader 0"), 1)
+    first = encoder.encode(msg, "commander")
+    second = encoder.encode(msg, "commander")
+    self.assertLess(len(second), len(first))
+    self.assertEqual(decoder.decode(first, True)[0], "commander")
+    dst, decoded = decoder.decode(second, True)
+    self.assertEqual(dst, "commander")
+    self.assertEqual(decoder.decode(encoder.encode(msg, 1 << 40), True)[0],
+                     1 << 40)
+    self.assertEqual(decoded.fields(), msg.fields())
+
+  def test_unpickling(self):
+    import os
+    class Exploit:
+      def __reduce__(self):
+        return (os.getcwd, ())
+    data = HEADER.pack(VERSION, PICKLED) + pickle.dumps(Exploit())
+    self.assertRaises(pickle.UnpicklingError, Decoder().decode, data)
+    msg = RequestMessage("c", Command("c", 0, {"op": [1.5, {2}, b"x"]}))
+    self.assertEqual(self.roundtrip(msg).command, msg.command)
+
+  def test_version(self):
+    data = bytearray(Encoder().encode(CatchupMessage("replica 0", 1)))
+    data[0] = VERSION+1
+    self.assertRaises(ValueError, Decoder().decode, bytes(data))
+
+if __name__ == "__main__":
+  ut.main()
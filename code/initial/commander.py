@@ -1,40 +1,140 @@
 from message import P2aMessage,P2bMessage,PreemptedMessage,DecisionMessage
+from message import P2aBatchMessage,P2bBatchMessage,ProposeMessage
+from message import CheckpointMessage
 from process import Process
-from utils import Command
+from utils import P2ABATCH,P2ALINGER,RESEND,THRIFTY,preferred
+import heapq
+import itertools
 
 class Commander(Process):
-  def __init__(self, env, id, leader, acceptors, replicas,
-               ballot_number, slot_number, command):
+  ephemeral = True
+
+  def __init__(self, env, id, leader, acceptors, replicas, leaders,
+               ballot_number, batch_size=P2ABATCH, linger=P2ALINGER,
+               thrifty=THRIFTY):
     Process.__init__(self, env, id)
     self.leader = leader
     self.acceptors = acceptors
     self.replicas = replicas
+    self.leaders = leaders
     self.ballot_number = ballot_number
-    self.slot_number = slot_number
-    self.command = command
+    # One commander runs phase 2 for every slot its leader proposes in
+    # this ballot: slot number -> (command, acceptors still to answer)
+    self.slots = {}
+    # Proposals not sent yet. They go out together once batch_size of
+    # them are waiting or the oldest one has waited linger seconds.
+    self.batch = []
+    self.batch_size = batch_size
+    self.linger = linger
+    self.flush_at = None
+    # Unless thrifty is None, a batch only goes to a majority of the
+    # acceptors, another one for every batch. The others are asked for
+    # the slots still undecided after thrifty seconds, and acceptors
+    # that were too slow are left out until they answer again. After
+    # that, and without thrifty, slots still undecided are sent again
+    # every RESEND seconds to the acceptors that have not answered.
+    self.thrifty = thrifty
+    self.turn = 0
+    self.slow = set()
+    self.waiting = [] # heap of (deadline, number, slot numbers, asked)
+    self.sequence = itertools.count()
     self.env.addProc(self)
 
-  def body(self):
-    waitfor = set()
-    for a in self.acceptors:
-      self.sendMessage(a, P2aMessage(self.id, self.ballot_number,
-                                     self.slot_number, self.command))
-      waitfor.add(a)
+  def propose(self, acceptors, proposals):
+    for a in acceptors:
+      if len(proposals) == 1:
+        slot_number, command = proposals[0]
+        self.sendMessage(a, P2aMessage(self.id, self.ballot_number,
+                                       slot_number, command))
+      else:
+        self.sendMessage(a, P2aBatchMessage(self.id, self.ballot_number,
+                                            proposals))
+
+  def flush(self):
+    if self.thrifty is None:
+      asked, wait = self.acceptors, RESEND
+    else:
+      asked, wait = preferred(self.acceptors, self.turn, self.slow), \
+                    self.thrifty
+      self.turn += 1
+    self.expect([sn for sn, c in self.batch], asked, wait)
+    self.propose(asked, self.batch)
+    self.batch = []
+
+  def expect(self, slot_numbers, asked, wait):
+    heapq.heappush(self.waiting, (self.clock() + wait, next(self.sequence),
+                                  slot_numbers, asked))
+
+  def resend(self):
+    now = self.clock()
+    while self.waiting and self.waiting[0][0] <= now:
+      deadline, n, slot_numbers, asked = heapq.heappop(self.waiting)
+      proposals = []
+      missing = set()
+      for sn in slot_numbers:
+        if sn in self.slots:
+          command, waitfor = self.slots[sn]
+          proposals.append((sn, command))
+          missing.update(waitfor)
+      if proposals:
+        self.slow.update(a for a in asked if a in missing)
+        self.propose([a for a in self.acceptors if a in missing], proposals)
+        self.expect([sn for sn, c in proposals], self.acceptors, RESEND)
 
+  def accepted(self, acceptor, slot_number):
+    self.slow.discard(acceptor)
+    if slot_number not in self.slots:
+      return
+    command, waitfor = self.slots[slot_number]
+    if acceptor in waitfor:
+      waitfor.remove(acceptor)
+      if len(waitfor) < float(len(self.acceptors))/2:
+        # Leaders learn decisions too, so that a scout never has to
+        # ask for the pvalues of decided slots.
+        for r in self.replicas + self.leaders:
+          self.sendMessage(r, DecisionMessage(self.id, slot_number, command))
+        del self.slots[slot_number]
+
+  async def body(self):
     while True:
-      msg = self.getNextMessage()
-      if isinstance(msg, P2bMessage):
-        if self.ballot_number == msg.ballot_number and msg.src in waitfor:
-          waitfor.remove(msg.src)
-          if len(waitfor) < float(len(self.acceptors))/2:
-            for r in self.replicas:
-              self.sendMessage(r, DecisionMessage(self.id,
-                                                  self.slot_number,
-                                                  self.command))
-            return
+      deadlines = [self.waiting[0][0]] if self.waiting else []
+      if self.batch:
+        deadlines.append(self.flush_at)
+      timeout = None
+      if deadlines:
+        timeout = max(0, min(deadlines) - self.clock())
+      msg = await self.getNextMessage(timeout)
+      if self.waiting and self.waiting[0][0] <= self.clock():
+        self.resend()
+      if msg is None:
+        pass
+      elif isinstance(msg, ProposeMessage):
+        if msg.slot_number not in self.slots:
+          self.slots[msg.slot_number] = (msg.command, set(self.acceptors))
+          if not self.batch:
+            self.flush_at = self.clock() + self.linger
+          self.batch.append((msg.slot_number, msg.command))
+          if len(self.batch) >= self.batch_size:
+            self.flush()
+      elif isinstance(msg, (P2bMessage, P2bBatchMessage)):
+        if self.ballot_number == msg.ballot_number:
+          if isinstance(msg, P2bMessage):
+            self.accepted(msg.src, msg.slot_number)
+          else:
+            for slot_number in msg.slot_numbers:
+              self.accepted(msg.src, slot_number)
         else:
           self.sendMessage(self.leader, PreemptedMessage(self.id,
                                                          msg.ballot_number))
           return
-
-
+      elif isinstance(msg, CheckpointMessage):
+        # Every replica has these slots; stop waiting for their p2bs.
+        for sn in [sn for sn in self.slots if sn <= msg.slot_number]:
+          del self.slots[sn]
+      elif isinstance(msg, PreemptedMessage):
+        # The leader moved on to a higher ballot.
+        return
+      # Checked after every message, as a steady stream of them would
+      # keep the body from ever timing out.
+      if self.batch and self.flush_at <= self.clock():
+        self.flush()
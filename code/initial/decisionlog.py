@@ -0,0 +1,245 @@
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import unittest as ut
+from collections import OrderedDict
+from utils import Command
+
+SEGMENTSLOTS = 65536  # Number of slots in one segment of a decision log
+MAXMAPPED = 16        # Number of sealed segments kept memory-mapped at once
+
+class Segment:
+  """
+  The decisions for SEGMENTSLOTS consecutive slots starting at base: a
+  data file with the pickled commands back to back, and an index file
+  with a fixed-size (offset, length) entry per slot. The index is
+  allocated in full when the segment is created and is always
+  memory-mapped; the data file is mapped once the segment is sealed.
+  """
+  ENTRY = struct.Struct("!QI")
+
+  def __init__(self, directory, base, nslots):
+    self.base = base
+    self.nslots = nslots
+    name = os.path.join(directory, "%012d" % base)
+    self.data = open(name + ".data", "a+b")
+    index = open(name + ".index", "a+b")
+    if os.fstat(index.fileno()).st_size < nslots * self.ENTRY.size:
+      index.truncate(nslots * self.ENTRY.size)
+    self.index = mmap.mmap(index.fileno(), nslots * self.ENTRY.size)
+    index.close()
+    self.mapped = None
+    # Entries with length 0 have not been written. The kernel may write
+    # the mapped index back before the data it points to, so after a
+    # crash an entry can also point past the end of the data file. The
+    # log ends before the first such entry; anything in either file
+    # after it is a torn append.
+    size = os.fstat(self.data.fileno()).st_size
+    self.count = 0
+    self.end = 0
+    while self.count < nslots:
+      offset, length = self.entry(self.count)
+      if length == 0 or offset != self.end or offset + length > size:
+        break
+      self.end += length
+      self.count += 1
+    i = self.count
+    while i < nslots and self.entry(i)[1] != 0:
+      self.ENTRY.pack_into(self.index, i * self.ENTRY.size, 0, 0)
+      i += 1
+    self.data.truncate(self.end)
+
+  def entry(self, i):
+    return self.ENTRY.unpack_from(self.index, i * self.ENTRY.size)
+
+  def full(self):
+    return self.count == self.nslots
+
+  def append(self, cmd):
+    payload = pickle.dumps(cmd, pickle.HIGHEST_PROTOCOL)
+    self.data.write(payload)
+    self.ENTRY.pack_into(self.index, self.count * self.ENTRY.size,
+                         self.end, len(payload))
+    self.end += len(payload)
+    self.count += 1
+
+  def read(self, slot):
+    offset, length = self.entry(slot - self.base)
+    if self.mapped is not None:
+      return pickle.loads(self.mapped[offset:offset+length])
+    self.data.flush()
+    return pickle.loads(os.pread(self.data.fileno(), length, offset))
+
+  def map(self):
+    if self.mapped is None and self.end > 0:
+      self.data.flush()
+      self.mapped = mmap.mmap(self.data.fileno(), self.end,
+                              access=mmap.ACCESS_READ)
+
+  def unmap(self):
+    if self.mapped is not None:
+      self.mapped.close()
+      self.mapped = None
+
+  def sync(self):
+    self.data.flush()
+    os.fsync(self.data.fileno())
+    self.index.flush()
+
+  def close(self):
+    self.unmap()
+    self.index.close()
+    self.data.close()
+
+class DecisionLog:
+  """
+  Append-only log of the commands a replica executes, one per slot
+  starting at slot 1, stored in a directory of fixed-size segments.
+  Any slot can be read back by its number, and replay() runs through
+  the log in order, so a replica does not have to keep its history in
+  memory to restart or to help other replicas catch up.
+
+  Next to the segments the directory holds the last snapshot saved,
+  so that a restart only replays the slots after it.
+  """
+  def __init__(self, directory, segment_slots=SEGMENTSLOTS):
+    self.directory = directory
+    self.segment_slots = segment_slots
+    os.makedirs(directory, exist_ok=True)
+    bases = sorted(int(f[:-len(".index")]) for f in os.listdir(directory)
+                   if f.endswith(".index"))
+    self.sealed = OrderedDict() # mapped sealed segments, least recent first
+    self.active = Segment(directory, bases[-1] if bases else 1, segment_slots)
+    self.next_slot = self.active.base + self.active.count
+
+  def segment(self, slot):
+    base = slot - (slot - 1) % self.segment_slots
+    if base == self.active.base:
+      return self.active
+    if base in self.sealed:
+      self.sealed.move_to_end(base)
+      return self.sealed[base]
+    segment = Segment(self.directory, base, self.segment_slots)
+    segment.map()
+    self.sealed[base] = segment
+    if len(self.sealed) > MAXMAPPED:
+      self.sealed.popitem(last=False)[1].close()
+    return segment
+
+  def append(self, slot, cmd):
+    assert slot == self.next_slot, "decisions are logged in slot order"
+    if self.active.full():
+      self.active.sync()
+      self.active.close()
+      self.active = Segment(self.directory, slot, self.segment_slots)
+    self.active.append(cmd)
+    self.next_slot += 1
+
+  def __contains__(self, slot):
+    return 1 <= slot < self.next_slot
+
+  def __getitem__(self, slot):
+    if slot not in self:
+      raise KeyError(slot)
+    return self.segment(slot).read(slot)
+
+  def replay(self, start=1, end=None):
+    """
+    Yields (slot, command) for every logged slot in [start, end).
+    """
+    if end is None or end > self.next_slot:
+      end = self.next_slot
+    for slot in range(max(start, 1), end):
+      yield slot, self[slot]
+
+  def sync(self):
+    self.active.sync()
+
+  def save_snapshot(self, snapshot):
+    """
+    Durably replaces the saved snapshot by snapshot, which can be any
+    picklable value. The decisions it covers must be synced first.
+    """
+    name = os.path.join(self.directory, "snapshot")
+    with open(name + ".tmp", "wb") as f:
+      pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(name + ".tmp", name)
+    fd = os.open(self.directory, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  def load_snapshot(self):
+    # The last snapshot saved, or None if there is none
+    try:
+      with open(os.path.join(self.directory, "snapshot"), "rb") as f:
+        return pickle.load(f)
+    except FileNotFoundError:
+      return None
+
+  def close(self):
+    for segment in self.sealed.values():
+      segment.close()
+    self.active.close()
+
+
+class test_decision_log(ut.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.log = DecisionLog(self.dir.name, segment_slots=4)
+    for s in range(1, 11):
+      self.log.append(s, Command("client", s, "op %d" % s))
+    self.log.sync()
+
+  def tearDown(self):
+    self.log.close()
+    self.dir.cleanup()
+
+  def test_read(self):
+    self.assertEqual(self.log[7].op, "op 7")
+    self.assertEqual(self.log[1].op, "op 1")
+    self.assertEqual(self.log[10].op, "op 10")
+    self.assertRaises(KeyError, self.log.__getitem__, 11)
+
+  def test_replay(self):
+    self.assertEqual([s for s, c in self.log.replay(3, 6)], [3, 4, 5])
+    self.assertEqual(len(list(self.log.replay())), 10)
+
+  def test_reopen(self):
+    self.log.close()
+    self.log = DecisionLog(self.dir.name, segment_slots=4)
+    self.assertEqual(self.log.next_slot, 11)
+    self.log.append(11, Command("client", 11, "op 11"))
+    self.assertEqual(self.log[11].op, "op 11")
+    self.assertEqual(self.log[5].op, "op 5")
+
+  def test_index_ahead_of_data(self):
+    # The index of slots 9 and 10 reached the disk, their data did not.
+    offset = self.log.active.entry(0)[0]
+    self.log.close()
+    with open(os.path.join(self.dir.name, "%012d.data" % 9), "r+b") as f:
+      f.truncate(offset + 3)
+    self.log = DecisionLog(self.dir.name, segment_slots=4)
+    self.assertEqual(self.log.next_slot, 9)
+    self.log.append(9, Command("client", 9, "new op 9"))
+    self.log.append(10, Command("client", 10, "new op 10"))
+    self.assertEqual(self.log[10].op, "new op 10")
+    self.assertEqual([c.op for s, c in self.log.replay(7)],
+                     ["op 7", "op 8", "new op 9", "new op 10"])
+
+  def test_snapshot(self):
+    self.assertIsNone(self.log.load_snapshot())
+    self.log.save_snapshot((8, {"a": 1}))
+    self.log.save_snapshot((10, {"a": 2}))
+    self.log.close()
+    self.log = DecisionLog(self.dir.name, segment_slots=4)
+    self.assertEqual(self.log.load_snapshot(), (10, {"a": 2}))
+    self.assertEqual(self.log.next_slot, 11)
+
+if __name__ == "__main__":
+  ut.main()
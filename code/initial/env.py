@@ -1,9 +1,13 @@
-import os, signal, sys, time
+import argparse, os, signal, sys, time
 from acceptor import Acceptor
+from client import Client
 from leader import Leader
 from message import RequestMessage
+from pool import WorkerPool
 from process import Process
 from replica import Replica
+import registry
+from transport import Transport, parseAddress
 from utils import *
 
 NACCEPTORS = 3
@@ -11,74 +15,131 @@ NREPLICAS = 2
 NLEADERS = 2
 NREQUESTS = 10
 NCONFIGS = 2
+LOGDIR = None   # Directory for acceptor and replica logs; None keeps
+                # all state in memory
 
 class Env:
-  def __init__(self):
+  # Carries messages to the processes on other nodes. RingFabric can
+  # take its place when all nodes run on one host.
+  fabric = Transport
+  # Scouts and commanders only live for a ballot, so they share a pool
+  # of this many threads rather than starting one each.
+  poolsize = POOLSIZE
+
+  def __init__(self, nodes=None, node=0):
     self.procs = {}
+    # With a list of node addresses, the processes are spread over the
+    # nodes round-robin and this Env only runs the ones placed on node.
+    self.nodes = nodes
+    self.node = node
+    self.placed = 0
+    self.transport = None
+    self.pool = WorkerPool(self.poolsize) if self.poolsize else None
+    registry.node = node
+    if nodes is not None:
+      self.transport = self.fabric(self, nodes[node])
+      self.transport.start()
+
+  clock = staticmethod(time.monotonic)
 
   def sendMessage(self, dst, msg):
     if dst in self.procs:
       self.procs[dst].deliver(msg)
+    elif self.transport is not None:
+      self.transport.send(dst, msg)
+
+  def place(self, pid):
+    if self.nodes is None:
+      return True
+    address = self.nodes[self.placed % len(self.nodes)]
+    self.placed += 1
+    if address == self.nodes[self.node]:
+      return True
+    self.transport.route(pid, address)
+    return False
 
   def addProc(self, proc):
-    self.procs[proc.id] = proc
-    proc.start()
+    if proc.ephemeral and self.pool is not None:
+      self.pool.add(proc)
+      self.procs[proc.id] = proc
+      self.pool.run(proc)
+    else:
+      self.procs[proc.id] = proc
+      proc.start()
 
   def removeProc(self, pid):
     del self.procs[pid]
+    registry.release(pid)
+
+  def request(self, r, msg):
+    # Only the first node plays the clients.
+    if self.node == 0:
+      self.sendMessage(r, msg)
+      time.sleep(1)
+
+  def perform(self, ops):
+    # Submits ops all at once and waits for their results.
+    if self.node == 0:
+      for op, future in [(op, self.client.submit(op)) for op in ops]:
+        print("client: result of", op, ":", future.result())
+
+  def logPath(self, pid, suffix):
+    if LOGDIR is None:
+      return None
+    return os.path.join(LOGDIR, registry.name(pid).replace(" ", "_") + suffix)
 
   def run(self):
     initialconfig = Config([], [], [])
     c = 0
 
     for i in range(NREPLICAS):
-      pid = "replica %d" % i
-      Replica(self, pid, initialconfig)
+      pid = registry.register("replica %d" % i)
+      if self.place(pid):
+        Replica(self, pid, initialconfig, logdir=self.logPath(pid, ".log"))
       initialconfig.replicas.append(pid)
     for i in range(NACCEPTORS):
-      pid = "acceptor %d.%d" % (c,i)
-      Acceptor(self, pid)
+      pid = registry.register("acceptor %d.%d" % (c,i))
+      if self.place(pid):
+        Acceptor(self, pid, self.logPath(pid, ".wal"))
       initialconfig.acceptors.append(pid)
     for i in range(NLEADERS):
-      pid = "leader %d.%d" % (c,i)
-      Leader(self, pid, initialconfig)
+      pid = registry.register("leader %d.%d" % (c,i))
+      if self.place(pid):
+        Leader(self, pid, initialconfig)
       initialconfig.leaders.append(pid)
-    for i in range(NREQUESTS):
-      pid = "client %d.%d" % (c,i)
-      for r in initialconfig.replicas:
-        cmd = Command(pid,0,"operation %d.%d" % (c,i))
-        self.sendMessage(r,RequestMessage(pid,cmd))
-        time.sleep(1)
+    pid = registry.register("client")
+    if self.node == 0:
+      self.client = Client(self, pid, initialconfig.replicas)
+    elif self.transport is not None:
+      self.transport.route(pid, self.nodes[0])
+    self.perform([("put", "key %d" % i, "value %d.%d" % (c,i))
+                  for i in range(NREQUESTS)])
 
     for c in range(1, NCONFIGS):
       # Create new configuration
       config = Config(initialconfig.replicas, [], [])
       for i in range(NACCEPTORS):
-        pid = "acceptor %d.%d" % (c,i)
-        Acceptor(self, pid)
+        pid = registry.register("acceptor %d.%d" % (c,i))
+        if self.place(pid):
+          Acceptor(self, pid, self.logPath(pid, ".wal"))
         config.acceptors.append(pid)
       for i in range(NLEADERS):
-        pid = "leader %d.%d" % (c,i)
-        Leader(self, pid, config)
+        pid = registry.register("leader %d.%d" % (c,i))
+        if self.place(pid):
+          Leader(self, pid, config)
         config.leaders.append(pid)
       # Send reconfiguration request
       for r in config.replicas:
         pid = "master %d.%d" % (c,i)
         cmd = ReconfigCommand(pid,0,str(config))
-        self.sendMessage(r, RequestMessage(pid, cmd))
-        time.sleep(1)
+        self.request(r, RequestMessage(pid, cmd))
       for i in range(WINDOW-1):
         pid = "master %d.%d" % (c,i)
         for r in config.replicas:
           cmd = Command(pid,0,"operation noop")
-          self.sendMessage(r, RequestMessage(pid, cmd))
-          time.sleep(1)
-      for i in range(NREQUESTS):
-        pid = "client %d.%d" % (c,i)
-        for r in config.replicas:
-          cmd = Command(pid,0,"operation %d.%d"%(c,i))
-          self.sendMessage(r, RequestMessage(pid, cmd))
-          time.sleep(1)
+          self.request(r, RequestMessage(pid, cmd))
+      self.perform([("put", "key %d" % i, "value %d.%d" % (c,i))
+                    for i in range(NREQUESTS)])
 
   def terminate_handler(self, signal, frame):
     self._graceexit()
@@ -89,7 +150,14 @@ class Env:
     os._exit(exitcode)
 
 def main():
-  e = Env()
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--nodes",
+                      type=lambda s: [parseAddress(a) for a in s.split(",")],
+                      help="comma-separated host:port or unix:path of every node")
+  parser.add_argument("--node", type=int, default=0,
+                      help="index in --nodes of the node to run here")
+  args = parser.parse_args()
+  e = Env(args.nodes, args.node)
   e.run()
   signal.signal(signal.SIGINT, e.terminate_handler)
   signal.signal(signal.SIGTERM, e.terminate_handler)
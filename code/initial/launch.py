@@ -0,0 +1,82 @@
+import argparse, multiprocessing, os, shutil, sys, tempfile, threading, time
+import env
+from multiprocessing import resource_tracker
+import ring
+from asyncenv import AsyncEnv
+from env import Env
+
+def roles():
+  # The number of replicas, acceptors and leaders Env.run() creates
+  return env.NREPLICAS + env.NCONFIGS * (env.NACCEPTORS + env.NLEADERS)
+
+def runNode(nodes, node, fabric, runtime="thread"):
+  if fabric == "shm":
+    Env.fabric = ring.RingFabric
+  e = (AsyncEnv if runtime == "async" else Env)(nodes, node)
+  e.run()
+  if node == 0:
+    # The first node plays the clients and is done once they are.
+    sys.stdout.flush()
+    os._exit(0)
+  threading.Event().wait()
+
+def launch(processes=None, fabric="unix", port=9200, runtime="thread"):
+  """
+  Runs Env.run() on one machine with its replicas, acceptors and
+  leaders spread over processes OS processes, by default one for each,
+  so that they do not share a GIL. Scouts and commanders run in the
+  process of the leader that spawned them. The processes send each
+  other messages over Unix sockets, through rings in shared memory if
+  fabric is "shm", or over TCP on ports from port upwards if fabric is
+  "tcp". With runtime "async", each process runs its roles on an
+  AsyncEnv. Returns once the clients are done.
+  """
+  if processes is None:
+    processes = roles()
+  directory = tempfile.mkdtemp(prefix="paxos")
+  if fabric == "unix":
+    nodes = [os.path.join(directory, "node%d.sock" % i)
+             for i in range(processes)]
+  elif fabric == "shm":
+    nodes = [os.path.join(directory, "node%d" % i) for i in range(processes)]
+    # The nodes share our tracker of shared memory, which forgets the
+    # rings once unlink() has removed them.
+    resource_tracker.ensure_running()
+  else:
+    nodes = [("127.0.0.1", port+i) for i in range(processes)]
+  others = [multiprocessing.Process(target=runNode,
+                                    args=(nodes, i, fabric, runtime),
+                                    daemon=True)
+            for i in range(1, processes)]
+  for p in others:
+    p.start()
+  first = multiprocessing.Process(target=runNode,
+                                  args=(nodes, 0, fabric, runtime))
+  first.start()
+  first.join()
+  for p in others:
+    p.terminate()
+    p.join()
+  if fabric == "shm":
+    ring.unlink(nodes)
+  shutil.rmtree(directory)
+  return first.exitcode
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--processes", type=int,
+                      help="number of OS processes, one per role by default")
+  parser.add_argument("--fabric", choices=["unix", "shm", "tcp"], default="unix")
+  parser.add_argument("--port", type=int, default=9200,
+                      help="first TCP port with --fabric tcp")
+  parser.add_argument("--runtime", choices=["thread", "async"], default="thread",
+                      help="run the roles of a process on threads or tasks")
+  args = parser.parse_args()
+  start = time.time()
+  exitcode = launch(args.processes, args.fabric, args.port, args.runtime)
+  print("launch: done in %.2fs" % (time.time() - start))
+  sys.exit(exitcode)
+
+
+if __name__=='__main__':
+  main()
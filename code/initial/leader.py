@@ -1,57 +1,310 @@
-from utils import BallotNumber
+import unittest as ut
+from utils import BallotNumber,P2ABATCH,P2ALINGER,LEASE,HEARTBEAT,CLOCKDRIFT
 from process import Process
+from timer import Scheduler
+import registry
 from commander import Commander
 from scout import Scout
 from message import ProposeMessage,AdoptedMessage,PreemptedMessage
+from message import CheckpointMessage,DecisionMessage,HeartbeatMessage
+from message import CatchupMessage
+from message import LeaseMessage,LeaseGrantMessage
+from message import ReadIndexMessage,ReadIndexReplyMessage,ReadRejectMessage
 
 class Leader(Process):
-  def __init__(self, env, id, config):
+  def __init__(self, env, id, config, batch_size=P2ABATCH, linger=P2ALINGER,
+               leases=True):
     Process.__init__(self, env, id)
     self.ballot_number = BallotNumber(0, self.id)
     self.active = False
     self.proposals = {}
+    self.scouting = None
+    self.commander = None
+    # Last checkpoint reported by each replica, and the highest slot
+    # that all replicas have checkpointed.
+    self.checkpoints = {}
+    self.checkpoint = 0
+    # Every slot below slot_decided is known to be decided. The slots
+    # above it known to be decided are kept in decided.
+    self.slot_decided = 1
+    self.decided = set()
+    # The commands of the decided slots above the checkpoint, for the
+    # replicas that missed a decision.
+    self.chosen = {}
+    self.batch_size = batch_size
+    self.linger = linger
+    # A preempted leader follows the leader of the highest ballot it
+    # has seen, and only competes with it again once it has not heard
+    # a heartbeat for LEASE seconds. Without leases, leaders compete
+    # as soon as they are preempted. The acceptors hold their leases
+    # for LEASE seconds too, so both sides agree on when one ends.
+    self.leases = leases
+    self.leader_ballot = self.ballot_number
+    self.lease_expiry = 0
+    self.election = None
+    self.heartbeat = None
+    # The active leader also asks the acceptors for a lease with every
+    # heartbeat. Once a majority granted one, no other leader can get a
+    # ballot adopted before leased_until, so until then the leader
+    # knows every decided slot and can answer ReadIndexMessages from
+    # the replicas on its own.
+    self.lease_id = 0
+    self.lease_rounds = {} # lease_id -> (time sent, acceptors that granted)
+    self.leased_until = 0
+    self.reads = []        # (time received, ReadIndexMessage)
+    self.timer = Scheduler(self.clock)
     self.config = config
     self.env.addProc(self)
 
-  def body(self):
-    print("Here I am: ", self.id)
-    Scout(self.env, "scout:%s:%s" % (str(self.id), str(self.ballot_number)),
-          self.id, self.config.acceptors, self.ballot_number)
+  def scout(self):
+    self.scouting = registry.ephemeral("scout:%s:%s", self.id,
+                                       self.ballot_number)
+    Scout(self.env, self.scouting, self.id, self.config.acceptors,
+          self.ballot_number, self.checkpoint+1)
+
+  def follow(self, ballot_number):
+    self.leased_until = 0
+    # The active leader answers the reads the replicas sent to every
+    # leader. Only keep those that may have arrived after it failed.
+    now = self.timer.clock()
+    self.reads = [(t, m) for t, m in self.reads if now - t < 2*LEASE]
+    if self.active:
+      self.sendMessage(self.commander,
+                       PreemptedMessage(self.id, ballot_number))
+    self.active = False
+    if not self.leases:
+      self.compete(ballot_number)
+      return
+    if ballot_number > self.leader_ballot:
+      self.leader_ballot = ballot_number
+    self.lease_expiry = self.timer.clock() + LEASE
+    if self.election is None:
+      self.election = self.timer.schedule(LEASE, self.elect)
+
+  def elect(self):
+    # Compete for leadership unless the leader renewed its lease.
+    now = self.timer.clock()
+    if now < self.lease_expiry:
+      self.election = self.timer.schedule(self.lease_expiry - now, self.elect)
+      return
+    self.election = None
+    self.compete(self.leader_ballot)
+
+  def compete(self, ballot_number):
+    # Scouts for a ballot above ballot_number. A leader that lost its
+    # own ballot follows a lower one, and must still never use a ballot
+    # twice: its old commander may have P2as for it on the way.
+    round = max(ballot_number, self.ballot_number).round
+    self.ballot_number = BallotNumber(round+1, self.id)
+    self.scout()
+
+  def beat(self):
+    if not self.active:
+      self.heartbeat = None
+      return
+    for l in self.config.leaders:
+      if l != self.id:
+        self.sendMessage(l, HeartbeatMessage(self.id, self.ballot_number))
+    self.lease_id += 1
+    self.lease_rounds[self.lease_id] = (self.timer.clock(), set())
+    self.lease_rounds.pop(self.lease_id - int(LEASE/HEARTBEAT), None)
+    for a in self.config.acceptors:
+      self.sendMessage(a, LeaseMessage(self.id, self.ballot_number,
+                                       self.lease_id))
+    self.heartbeat = self.timer.schedule(HEARTBEAT, self.beat)
+
+  def granted(self, msg):
+    if msg.ballot_number != self.ballot_number or \
+          msg.lease_id not in self.lease_rounds:
+      return
+    sent, acceptors = self.lease_rounds[msg.lease_id]
+    acceptors.add(msg.src)
+    if 2*len(acceptors) > len(self.config.acceptors):
+      del self.lease_rounds[msg.lease_id]
+      self.leased_until = max(self.leased_until,
+                              sent + LEASE*(1-CLOCKDRIFT))
+
+  def readIndex(self):
+    # Every slot that may have been decided so far
+    return max([self.slot_decided-1] + list(self.proposals) +
+               list(self.decided))
+
+  def answerReads(self):
+    if not self.active or self.timer.clock() >= self.leased_until:
+      return
+    index = self.readIndex()
+    for t, msg in self.reads:
+      self.sendMessage(msg.src, ReadIndexReplyMessage(self.id, msg.read_id,
+                                                      index))
+    self.reads = []
+
+  async def body(self):
+    print("Here I am: ", registry.name(self.id))
+    self.scout()
     while True:
-      msg = self.getNextMessage()
-      if isinstance(msg, ProposeMessage):
-        if msg.slot_number not in self.proposals:
-          self.proposals[msg.slot_number] = msg.command
+      msg = await self.getNextMessage(self.timer.timeout())
+      self.timer.run()
+      if msg is None:
+        pass
+      elif isinstance(msg, ProposeMessage):
+        # A replica proposes again when it hears of no decision, so the
+        # first proposal for the slot goes to the commander again, in
+        # case it got lost on the way.
+        sn = msg.slot_number
+        if sn >= self.slot_decided and sn not in self.decided:
+          self.proposals.setdefault(sn, msg.command)
           if self.active:
-            Commander(self.env,
-                      "commander:%s:%s:%s" % (str(self.id),
-                                              str(self.ballot_number),
-                                              str(msg.slot_number)),
-                      self.id, self.config.acceptors, self.config.replicas,
-                      self.ballot_number, msg.slot_number, msg.command)
+            self.sendMessage(self.commander,
+                             ProposeMessage(self.id, sn, self.proposals[sn]))
       elif isinstance(msg, AdoptedMessage):
-        if self.ballot_number == msg.ballot_number:
-          pmax = {}
-          for pv in msg.accepted:
-            if pv.slot_number not in pmax or \
-                  pmax[pv.slot_number] < pv.ballot_number:
-              pmax[pv.slot_number] = pv.ballot_number
-              self.proposals[pv.slot_number] = pv.command
+        # A follower ignores its scout if that scout was too late.
+        if self.ballot_number == msg.ballot_number and \
+              not self.leader_ballot > self.ballot_number:
+          # msg.accepted holds the pvalue with the highest ballot
+          # number for every slot. Decided slots are proposed again
+          # too, for any replica that missed their decision.
+          for pv in msg.accepted.range(self.checkpoint+1):
+            self.proposals[pv.slot_number] = pv.command
+          self.commander = registry.ephemeral("commander:%s:%s", self.id,
+                                              self.ballot_number)
+          Commander(self.env, self.commander,
+                    self.id, self.config.acceptors, self.config.replicas,
+                    self.config.leaders, self.ballot_number,
+                    self.batch_size, self.linger)
           for sn in self.proposals:
-            Commander(self.env,
-                      "commander:%s:%s:%s" % (str(self.id),
-                                              str(self.ballot_number),
-                                              str(sn)),
-                      self.id, self.config.acceptors, self.config.replicas,
-                      self.ballot_number, sn, self.proposals.get(sn))
+            self.sendMessage(self.commander,
+                             ProposeMessage(self.id, sn, self.proposals[sn]))
           self.active = True
-      elif isinstance(msg, PreemptedMessage):
+          if self.heartbeat is None and self.leases:
+            self.beat()
+      elif isinstance(msg, (PreemptedMessage, HeartbeatMessage)):
         if msg.ballot_number > self.ballot_number:
-          self.active = False
-          self.ballot_number = BallotNumber(msg.ballot_number.round+1,
-                                            self.id)
-          Scout(self.env, "scout:%s:%s" % (str(self.id),
-                                           str(self.ballot_number)),
-                self.id, self.config.acceptors, self.ballot_number)
+          self.follow(msg.ballot_number)
+        elif isinstance(msg, PreemptedMessage) and \
+              msg.src in (self.scouting, self.commander):
+          # An acceptor refused our ballot, though it is the highest,
+          # because it leased itself to another leader. The ballot is
+          # lost all the same; try again once the lease ran out.
+          self.follow(self.leader_ballot)
+      elif isinstance(msg, LeaseGrantMessage):
+        self.granted(msg)
+      elif isinstance(msg, ReadIndexMessage):
+        if self.leases:
+          self.reads.append((self.timer.clock(), msg))
+        else:
+          self.sendMessage(msg.src, ReadRejectMessage(self.id, msg.read_id))
+      elif isinstance(msg, DecisionMessage):
+        if msg.slot_number > self.checkpoint:
+          self.chosen[msg.slot_number] = msg.command
+        if msg.slot_number >= self.slot_decided:
+          self.decided.add(msg.slot_number)
+          while self.slot_decided in self.decided:
+            self.decided.remove(self.slot_decided)
+            self.proposals.pop(self.slot_decided, None)
+            self.slot_decided += 1
+      elif isinstance(msg, CheckpointMessage):
+        self.checkpoints[msg.src] = msg.slot_number
+        slot = min(self.checkpoints.get(r, 0) for r in self.config.replicas)
+        if slot > self.checkpoint:
+          self.checkpoint = slot
+          for sn in [sn for sn in self.proposals if sn <= slot]:
+            del self.proposals[sn]
+          for sn in [sn for sn in self.chosen if sn <= slot]:
+            del self.chosen[sn]
+          if self.slot_decided <= slot:
+            self.slot_decided = slot+1
+            self.decided = set(sn for sn in self.decided if sn > slot)
+          for a in self.config.acceptors:
+            self.sendMessage(a, CheckpointMessage(self.id, slot))
+          if self.active:
+            self.sendMessage(self.commander, CheckpointMessage(self.id, slot))
+      elif isinstance(msg, CatchupMessage):
+        for sn in sorted(self.chosen):
+          if sn >= msg.slot_number:
+            self.sendMessage(msg.src,
+                             DecisionMessage(self.id, sn, self.chosen[sn]))
       else:
         print("Leader: unknown msg type")
+      if self.reads:
+        self.answerReads()
+
+
+class test_leader(ut.TestCase):
+  def run_cluster(self, crash=None):
+    # Runs a cluster in SimEnv for 8 seconds, with requests coming in
+    # for the first 6, and returns the env, the replicas, the leaders
+    # and (time, leader) for every scout started. Crashes the active
+    # leader at time crash.
+    import io, contextlib
+    from message import RequestMessage
+    from sim import SimEnv, cluster
+    from utils import Command
+    class TracingEnv(SimEnv):
+      def addProc(self, proc):
+        if isinstance(proc, Scout):
+          self.scouts.append((self.now, proc.leader))
+        SimEnv.addProc(self, proc)
+      def sendMessage(self, dst, msg):
+        if isinstance(msg, HeartbeatMessage):
+          self.heartbeats += 1
+        SimEnv.sendMessage(self, dst, msg)
+    env = TracingEnv(1, jitter=0.002)
+    env.scouts = []
+    env.heartbeats = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+      config, replicas, acceptors, leaders = cluster(env)
+      for i in range(120):
+        cmd = Command("client", i, ("put", "k", i))
+        for r in config.replicas:
+          env.at(i * 0.05, env.arrive, r, RequestMessage("client", cmd))
+      if crash is not None:
+        env.run(until=crash)
+        env.crash([l for l in leaders if l.active][0].id)
+      env.run(until=8)
+    for r in replicas:
+      for i in range(120):
+        self.assertIn(Command("client", i, None), r.executed)
+    return env, replicas, leaders
+
+  def test_stable(self):
+    # Once one leader is active, the other follows its heartbeats and
+    # no leader scouts again.
+    env, replicas, leaders = self.run_cluster()
+    self.assertEqual(len([l for l in leaders if l.active]), 1)
+    self.assertFalse([t for t, l in env.scouts if t > LEASE])
+    self.assertGreater(env.heartbeats, 8 / HEARTBEAT / 2)
+
+  def test_takeover(self):
+    # The follower takes over once, when the lease of the crashed
+    # leader runs out, and the requests after the crash are decided.
+    env, replicas, leaders = self.run_cluster(crash=3)
+    survivor = [l for l in leaders if l.id in env.procs]
+    self.assertEqual(len(survivor), 1)
+    self.assertTrue(survivor[0].active)
+    takeovers = [(t, l) for t, l in env.scouts if t > 3]
+    self.assertEqual(len(takeovers), 1)
+    t, l = takeovers[0]
+    self.assertEqual(l, survivor[0].id)
+    self.assertGreaterEqual(t, 3 + LEASE - HEARTBEAT)
+    self.assertLess(t, 3 + LEASE + HEARTBEAT)
+
+  def test_ballots_increase(self):
+    # Preempted, then refused by a leased acceptor: each time the leader
+    # competes again, it does so with a ballot it never used.
+    import io, contextlib
+    from sim import SimEnv
+    from utils import Config
+    env = SimEnv()
+    with contextlib.redirect_stdout(io.StringIO()):
+      leader = Leader(env, "leader 0", Config([], ["acceptor 0"], []))
+      other = BallotNumber(0, "leader 1")
+      ballots = []
+      env.at(0.1, env.arrive, leader.id, PreemptedMessage("scout", other))
+      env.at(LEASE + 0.2, lambda: env.arrive(
+        leader.id, PreemptedMessage(leader.scouting, other)))
+      for t in (0.05, LEASE + 0.15, 2*LEASE + 0.25):
+        env.at(t, lambda: ballots.append(leader.ballot_number))
+      env.run(until=3*LEASE)
+    self.assertEqual(len(ballots), 3)
+    self.assertLess(ballots[0], ballots[1])
+    self.assertLess(ballots[1], ballots[2])
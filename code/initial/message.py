@@ -1,22 +1,36 @@
 class Message:
+  __slots__ = ('src',)
+
   def __init__(self, src):
     self.src = src
 
+  def fields(self):
+    # The values of all fields, in the order the constructor takes them
+    return tuple(getattr(self, f) for cls in reversed(type(self).__mro__)
+                 for f in cls.__dict__.get('__slots__', ()))
+
   def __str__(self):
-    return str(self.__dict__)
+    return str({f: getattr(self, f) for cls in reversed(type(self).__mro__)
+                for f in cls.__dict__.get('__slots__', ())})
 
 class P1aMessage(Message):
-  def __init__(self, src, ballot_number):
+  # Every slot below slot_number is known to be decided, so acceptors
+  # only return the pvalues from slot_number on.
+  __slots__ = ('ballot_number', 'slot_number')
+  def __init__(self, src, ballot_number, slot_number):
     Message.__init__(self, src)
     self.ballot_number = ballot_number
+    self.slot_number = slot_number
 
 class P1bMessage(Message):
+  __slots__ = ('ballot_number', 'accepted')
   def __init__(self, src, ballot_number, accepted):
     Message.__init__(self, src)
     self.ballot_number = ballot_number
     self.accepted = accepted
 
 class P2aMessage(Message):
+  __slots__ = ('ballot_number', 'slot_number', 'command')
   def __init__(self, src, ballot_number, slot_number, command):
     Message.__init__(self, src)
     self.ballot_number = ballot_number
@@ -24,34 +38,132 @@ class P2aMessage(Message):
     self.command = command
 
 class P2bMessage(Message):
+  __slots__ = ('ballot_number', 'slot_number')
   def __init__(self, src, ballot_number, slot_number):
     Message.__init__(self, src)
     self.ballot_number = ballot_number
     self.slot_number = slot_number
 
+class P2aBatchMessage(Message):
+  __slots__ = ('ballot_number', 'proposals')
+  def __init__(self, src, ballot_number, proposals):
+    Message.__init__(self, src)
+    self.ballot_number = ballot_number
+    self.proposals = proposals # list of (slot number, command) pairs
+
+class P2bBatchMessage(Message):
+  __slots__ = ('ballot_number', 'slot_numbers')
+  def __init__(self, src, ballot_number, slot_numbers):
+    Message.__init__(self, src)
+    self.ballot_number = ballot_number
+    self.slot_numbers = slot_numbers
+
 class PreemptedMessage(Message):
+  __slots__ = ('ballot_number',)
   def __init__(self, src, ballot_number):
     Message.__init__(self, src)
     self.ballot_number = ballot_number
 
 class AdoptedMessage(Message):
+  __slots__ = ('ballot_number', 'accepted')
   def __init__(self, src, ballot_number, accepted):
     Message.__init__(self, src)
     self.ballot_number = ballot_number
     self.accepted = accepted
 
 class DecisionMessage(Message):
+  __slots__ = ('slot_number', 'command')
   def __init__(self, src, slot_number, command):
     Message.__init__(self, src)
     self.slot_number = slot_number
     self.command = command
 
+class CheckpointMessage(Message):
+  # Sent by a replica to the leaders once it has checkpointed its state
+  # up to and including slot_number, and by a leader to the acceptors
+  # and its commander once every replica has done so.
+  __slots__ = ('slot_number',)
+  def __init__(self, src, slot_number):
+    Message.__init__(self, src)
+    self.slot_number = slot_number
+
+class CatchupMessage(Message):
+  # Sent by a replica that restarts to the other replicas, asking for
+  # the decisions from slot_number on.
+  __slots__ = ('slot_number',)
+  def __init__(self, src, slot_number):
+    Message.__init__(self, src)
+    self.slot_number = slot_number
+
+class HeartbeatMessage(Message):
+  # Sent by the active leader to the other leaders to renew its lease.
+  __slots__ = ('ballot_number',)
+  def __init__(self, src, ballot_number):
+    Message.__init__(self, src)
+    self.ballot_number = ballot_number
+
+class LeaseMessage(Message):
+  # Sent by the active leader to the acceptors to ask for a lease on
+  # ballot_number. Acceptors answer with a LeaseGrantMessage.
+  __slots__ = ('ballot_number', 'lease_id')
+  def __init__(self, src, ballot_number, lease_id):
+    Message.__init__(self, src)
+    self.ballot_number = ballot_number
+    self.lease_id = lease_id
+
+class LeaseGrantMessage(Message):
+  __slots__ = ('ballot_number', 'lease_id')
+  def __init__(self, src, ballot_number, lease_id):
+    Message.__init__(self, src)
+    self.ballot_number = ballot_number
+    self.lease_id = lease_id
+
+class ReadMessage(Message):
+  # A client command that only reads the state, sent to a replica.
+  __slots__ = ('command',)
+  def __init__(self, src, command):
+    Message.__init__(self, src)
+    self.command = command
+
+class ReadIndexMessage(Message):
+  # Sent by a replica to the leaders to learn up to which slot it has to
+  # execute before it may serve the reads it received so far.
+  __slots__ = ('read_id',)
+  def __init__(self, src, read_id):
+    Message.__init__(self, src)
+    self.read_id = read_id
+
+class ReadIndexReplyMessage(Message):
+  __slots__ = ('read_id', 'slot_number')
+  def __init__(self, src, read_id, slot_number):
+    Message.__init__(self, src)
+    self.read_id = read_id
+    self.slot_number = slot_number
+
+class ReadRejectMessage(Message):
+  # Sent by a leader without leases, which cannot give a read index.
+  # The replica puts the reads through the log instead.
+  __slots__ = ('read_id',)
+  def __init__(self, src, read_id):
+    Message.__init__(self, src)
+    self.read_id = read_id
+
 class RequestMessage(Message):
+  __slots__ = ('command',)
   def __init__(self, src, command):
     Message.__init__(self, src)
     self.command = command
 
+class ResponseMessage(Message):
+  # Sent by a replica to the client of a command once it is performed.
+  __slots__ = ('req_id', 'result')
+  def __init__(self, src, req_id, result):
+    Message.__init__(self, src)
+    self.req_id = req_id
+    self.result = result
+
 class ProposeMessage(Message):
+  __slots__ = ('slot_number', 'command')
   def __init__(self, src, slot_number, command):
     Message.__init__(self, src)
     self.slot_number = slot_number
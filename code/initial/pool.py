@@ -0,0 +1,215 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+import traceback
+import unittest as ut
+from collections import deque
+
+TURN = 64  # Messages a process handles before it lets others run
+
+class PooledInbox:
+  """
+  The inbox of a process that runs on a WorkerPool. It also holds the
+  body of the process: a message put into the inbox while the body
+  waits for one makes the process ready to run again, so a waiting
+  process does not keep a worker.
+  """
+  def __init__(self, pool, proc):
+    self.pool = pool
+    self.proc = proc
+    self.body = proc.body()
+    self.receive = None  # what the body awaits, None until it started
+    self.messages = deque()
+    self.lock = threading.Lock()
+    self.ready = True    # queued or running on a worker
+    self.expired = False # the timeout of the body has passed
+    self.timer = 0       # counts waits, to tell stale timeouts apart
+
+  def put(self, msg):
+    with self.lock:
+      self.messages.append(msg)
+      if self.ready:
+        return
+      self.ready = True
+    self.pool.ready.put(self)
+
+  def expire(self, timer):
+    with self.lock:
+      if self.ready or timer != self.timer:
+        return
+      self.ready = self.expired = True
+    self.pool.ready.put(self)
+
+  def resume(self, msg):
+    try:
+      self.receive = self.body.send(msg)
+      return True
+    except StopIteration:
+      pass
+    except Exception:
+      # A failing body takes only its own process down, not the worker.
+      traceback.print_exc()
+    # Stays ready, so that it is never queued again.
+    self.proc.env.removeProc(self.proc.id)
+    return False
+
+  def step(self):
+    # Runs the body on the calling worker until it waits for a message
+    # that has not arrived, it is done, or it had its turn.
+    if self.receive is None and not self.resume(None):
+      return
+    for i in range(TURN):
+      timeout = self.receive.timeout
+      wait = False
+      with self.lock:
+        if self.messages:
+          msg = self.messages.popleft()
+        elif self.expired or (timeout is not None and timeout <= 0):
+          msg = None
+        else:
+          wait = True
+          self.ready = False
+          self.timer += 1
+          timer = self.timer
+        self.expired = False
+      if wait:
+        if timeout is not None:
+          self.pool.after(timeout, self, timer)
+        return
+      if not self.resume(msg):
+        return
+    self.pool.ready.put(self)
+
+class WorkerPool:
+  """
+  Runs the bodies of processes on at most size threads, which are
+  started as they are needed and then reused, rather than on a thread
+  of their own. Processes that are ready to run wait in one queue and
+  timeouts are kept by one more thread.
+
+  A body runs on a worker until it awaits a message, so it must not
+  block: one that sleeps or waits on I/O keeps a worker from every
+  other process. Sending never blocks, whatever the fabric, so
+  scouts and commanders, the only processes run here, never do.
+  """
+  def __init__(self, size):
+    self.size = size
+    self.ready = queue.SimpleQueue()
+    self.lock = threading.Lock()
+    self.workers = 0
+    self.idle = 0
+    self.timers = [] # heap of (deadline, sequence number, inbox, timer)
+    self.sequence = itertools.count()
+    self.timed = threading.Condition(self.lock)
+    self.ticking = False
+
+  def add(self, proc):
+    """
+    Gives proc an inbox whose messages are handled on this pool. The
+    caller registers proc before run() starts it.
+    """
+    proc.inbox = PooledInbox(self, proc)
+
+  def run(self, proc):
+    with self.lock:
+      if self.idle == 0 and self.workers < self.size:
+        self.workers += 1
+        threading.Thread(target=self.work, daemon=True).start()
+    self.ready.put(proc.inbox)
+
+  def work(self):
+    while True:
+      with self.lock:
+        self.idle += 1
+      inbox = self.ready.get()
+      with self.lock:
+        self.idle -= 1
+      inbox.step()
+
+  def after(self, delay, inbox, timer):
+    with self.timed:
+      heapq.heappush(self.timers, (time.monotonic() + delay,
+                                   next(self.sequence), inbox, timer))
+      if not self.ticking:
+        self.ticking = True
+        threading.Thread(target=self.tick, daemon=True).start()
+      self.timed.notify()
+
+  def tick(self):
+    while True:
+      with self.timed:
+        while True:
+          now = time.monotonic()
+          if self.timers and self.timers[0][0] <= now:
+            break
+          self.timed.wait(self.timers[0][0] - now if self.timers else None)
+        deadline, sequence, inbox, timer = heapq.heappop(self.timers)
+      inbox.expire(timer)
+
+
+class test_pool(ut.TestCase):
+  class Env:
+    def __init__(self):
+      self.procs = {}
+      self.done = threading.Event()
+
+    def removeProc(self, pid):
+      del self.procs[pid]
+      if not self.procs:
+        self.done.set()
+
+  class Echo:
+    # Counts to n, a message or a timeout at a time
+    def __init__(self, env, pool, id, n, timeout):
+      from process import Receive
+      self.env, self.id, self.n, self.timeout = env, id, n, timeout
+      self.Receive = Receive
+      self.got = []
+      pool.add(self)
+      env.procs[id] = self
+      pool.run(self)
+
+    async def body(self):
+      while len(self.got) < self.n:
+        self.got.append(await self.Receive(self.timeout))
+
+  def test_messages_and_timeouts(self):
+    env = self.Env()
+    pool = WorkerPool(2)
+    threads = threading.active_count()
+    procs = [self.Echo(env, pool, i, 100, None) for i in range(50)]
+    sleepy = self.Echo(env, pool, "sleepy", 3, 0.01)
+    for n in range(100):
+      for p in procs:
+        p.inbox.put(n)
+    self.assertTrue(env.done.wait(5))
+    for p in procs:
+      self.assertEqual(p.got, list(range(100)))
+    self.assertEqual(sleepy.got, [None] * 3)
+    # Two workers and the timer, however many processes ran
+    self.assertLessEqual(threading.active_count(), threads + 3)
+
+  def test_failing_bodies(self):
+    # Bodies that raise leave the workers to the others.
+    import io, contextlib
+    class Failing(self.Echo):
+      async def body(self):
+        await self.Receive(None)
+        raise RuntimeError("failing")
+    env = self.Env()
+    pool = WorkerPool(2)
+    with contextlib.redirect_stderr(io.StringIO()) as err:
+      failing = [Failing(env, pool, i, 1, None) for i in range(2)]
+      for p in failing:
+        p.inbox.put("message")
+      good = self.Echo(env, pool, "good", 3, None)
+      for n in range(3):
+        good.inbox.put(n)
+      self.assertTrue(env.done.wait(5))
+    self.assertEqual(good.got, [0, 1, 2])
+    self.assertEqual(err.getvalue().count("RuntimeError: failing"), 2)
+
+if __name__ == "__main__":
+  ut.main()
@@ -1,22 +1,71 @@
 import multiprocessing
+import queue
 from threading import Thread
 
+def local_inbox():
+  return queue.SimpleQueue()
+
+def manager_inbox():
+  return multiprocessing.Manager().Queue()
+
+class Receive:
+  # What a body awaits to get its next message. Whoever runs the body
+  # gets the message and sends it back in.
+  __slots__ = ('timeout',)
+
+  def __init__(self, timeout):
+    self.timeout = timeout
+
+  def __await__(self):
+    return (yield self)
+
 class Process(Thread):
+  # Backend for the incoming message queue of every process. The
+  # in-process queue is the default; switch to manager_inbox only when
+  # messages have to cross OS process boundaries, since it starts a
+  # Manager server per process and pickles every message.
+  inbox_factory = staticmethod(local_inbox)
+  # Whether the process only lives for a short while, which lets the
+  # Env run it on a pool of threads.
+  ephemeral = False
+
   def __init__(self, env, id):
     super(Process, self).__init__()
-    self.inbox = multiprocessing.Manager().Queue()
+    self.inbox = self.inbox_factory()
     self.env = env
     self.id = id
 
+  # The body of a process is a coroutine that awaits its messages. On
+  # its own thread it is run by run(), which blocks on the inbox
+  # whenever the body awaits a message; asyncenv.AsyncEnv runs bodies
+  # as tasks on an event loop instead.
   def run(self):
     try:
-      self.body()
+      body = self.body()
+      try:
+        receive = body.send(None)
+        while True:
+          receive = body.send(self.waitForMessage(receive.timeout))
+      except StopIteration:
+        pass
       self.env.removeProc(self.id)
     except EOFError:
       print("Exiting..")
 
-  def getNextMessage(self):
-    return self.inbox.get()
+  def getNextMessage(self, timeout=None):
+    # To be awaited; gives None if no message arrives within timeout
+    # seconds.
+    return Receive(timeout)
+
+  def waitForMessage(self, timeout=None):
+    try:
+      return self.inbox.get(timeout=timeout)
+    except queue.Empty:
+      return None
+
+  def clock(self):
+    # Seconds on the clock of the environment, which need not be real
+    return self.env.clock()
 
   def sendMessage(self, dst, msg):
     self.env.sendMessage(dst, msg)
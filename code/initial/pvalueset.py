@@ -0,0 +1,117 @@
+from utils import PValue
+import unittest as ut
+
+class PValueSet:
+  """PValueSet encloses a set of pvalues with the highest ballotnumber
+  (always) and supports corresponding set functions. It keeps at most
+  one pvalue per slot_number, so its size is bounded by the number of
+  slots rather than by the number of pvalues ever accepted.
+  """
+  __slots__ = ('pvalues', 'low', 'high')
+
+  def __init__(self, pvalues=()):
+    self.pvalues = {} # indexed by slot_number: pvalue
+    self.low = 1      # no slot_number below low is in the set
+    self.high = 0     # no slot_number above high is in the set
+    for pvalue in pvalues:
+      self.add(pvalue)
+
+  def add(self, pvalue):
+    """Adds given PValue to the PValueSet overwriting matching
+    (commandnumber,proposal) if it exists and has a smaller ballotnumber
+    """
+    slot_number = pvalue.slot_number
+    if slot_number < self.low:
+      return
+    current = self.pvalues.get(slot_number)
+    if current is None:
+      self.pvalues[slot_number] = pvalue
+      if slot_number > self.high:
+        self.high = slot_number
+    elif current.ballot_number < pvalue.ballot_number:
+      self.pvalues[slot_number] = pvalue
+
+  def remove(self, pvalue):
+    """Removes given pvalue"""
+    del self.pvalues[pvalue.slot_number]
+
+  def update(self, given_pvalueset):
+    """Updates the pvalues of given_pvalueset with the pvalues of the
+    pvalueset overwriting the slot_numbers with lower ballotnumber.
+    Takes time linear in the size of given_pvalueset.
+    """
+    for candidate in given_pvalueset.pvalues.values():
+      self.add(candidate)
+
+  def slots(self, start, end):
+    """Returns the slot_numbers in [start, end) that are in the set,
+    walking whichever is smaller: the range or the set.
+    """
+    start = max(start, self.low)
+    end = min(end, self.high+1)
+    if end - start <= len(self.pvalues):
+      return [s for s in range(start, end) if s in self.pvalues]
+    return [s for s in self.pvalues if start <= s < end]
+
+  def range(self, start, end=None):
+    """Returns a new PValueSet with the pvalues for slot_numbers in
+    [start, end), or from start on if end is None
+    """
+    if end is None:
+      end = self.high+1
+    result = PValueSet()
+    for s in self.slots(start, end):
+      result.add(self.pvalues[s])
+    return result
+
+  def truncate(self, slot_number):
+    """Removes all pvalues below slot_number and ignores any pvalue
+    for those slot_numbers that is added later on
+    """
+    for s in self.slots(self.low, slot_number):
+      del self.pvalues[s]
+    self.low = max(self.low, slot_number)
+
+  def __iter__(self):
+    """Iterates over the PValues in the PValueSet"""
+    return iter(self.pvalues.values())
+
+  def __len__(self):
+    """Returns the number of PValues in the PValueSet"""
+    return len(self.pvalues)
+
+  def __str__(self):
+    """Returns PValueSet information"""
+    return "\n".join(str(pvalue) for pvalue in self.pvalues.values())
+
+
+class test_pvalueset(ut.TestCase):
+  def setUp(self):
+    self.pvalues = PValueSet([PValue(1, s, "op %d" % s) for s in range(1, 11)])
+
+  def test_highest_ballot(self):
+    self.pvalues.add(PValue(2, 3, "new op"))
+    self.pvalues.add(PValue(0, 4, "old op"))
+    self.assertEqual(self.pvalues.pvalues[3].command, "new op")
+    self.assertEqual(self.pvalues.pvalues[4].command, "op 4")
+    self.assertEqual(len(self.pvalues), 10)
+
+  def test_range(self):
+    self.assertEqual(sorted(pv.slot_number for pv in self.pvalues.range(8)),
+                     [8, 9, 10])
+    self.assertEqual(len(self.pvalues.range(3, 5)), 2)
+
+  def test_truncate(self):
+    self.pvalues.truncate(6)
+    self.assertEqual(len(self.pvalues), 5)
+    self.pvalues.add(PValue(3, 2, "late op"))
+    self.assertEqual(len(self.pvalues), 5)
+
+  def test_update(self):
+    other = PValueSet([PValue(2, 10, "new op"), PValue(2, 11, "op 11")])
+    self.pvalues.update(other)
+    self.assertEqual(len(self.pvalues), 11)
+    self.assertEqual(self.pvalues.pvalues[10].command, "new op")
+
+if __name__ == "__main__":
+  ut.main()
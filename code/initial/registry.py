@@ -0,0 +1,96 @@
+import itertools
+import unittest as ut
+
+# Processes are identified by small integers rather than by their names,
+# so that routing, quorum tracking and ballot comparisons only ever hash
+# and compare ints. The names are kept here for logging.
+#
+# Replicas, acceptors and leaders are registered by every node in the
+# same order, so they get the same pid everywhere. Scouts and commanders
+# are created on one node only; their pids carry that node's number in
+# the high bits so they cannot clash with pids made on other nodes.
+
+NODEBITS = 32 # Low bits of an ephemeral pid that number it within its node
+
+node = 0
+names = {}  # pid -> name, or (format, args) for ephemeral processes
+ids = {}    # name -> pid of the registered processes
+registered = 0  # pids handed out so far to registered processes
+# Ephemeral pids are numbered by a counter whose next() is atomic, as
+# leaders and pool workers create processes at the same time.
+sequence = itertools.count(1)
+
+def register(name):
+  """
+  Returns the pid of the replica, acceptor or leader called name.
+  """
+  global registered
+  if name not in ids:
+    registered += 1
+    ids[name] = registered
+    names[registered] = name
+  return ids[name]
+
+def ephemeral(format, *args):
+  """
+  Returns a new pid for a short-lived process. Its name is format % args,
+  but is only built when it is logged.
+  """
+  pid = ((node+1) << NODEBITS) | next(sequence)
+  names[pid] = (format, args)
+  return pid
+
+def release(pid):
+  # Registered pids are kept, as configurations may refer to them again.
+  if type(names.get(pid)) is tuple:
+    del names[pid]
+
+def name(pid):
+  """
+  Returns the name of pid, or pid itself if it is not an int from this
+  registry.
+  """
+  n = names.get(pid)
+  if n is None:
+    return pid
+  if type(n) is tuple:
+    format, args = n
+    return format % tuple(name(a) for a in args)
+  return n
+
+def lookup(n):
+  return ids.get(n, n)
+
+
+class test_registry(ut.TestCase):
+  def test_register(self):
+    a = register("test 0")
+    self.assertEqual(register("test 0"), a)
+    self.assertNotEqual(register("test 1"), a)
+    self.assertEqual(name(a), "test 0")
+    self.assertEqual(lookup("test 0"), a)
+
+  def test_ephemeral(self):
+    a = register("test 0")
+    e = ephemeral("child:%s:%s", a, 7)
+    self.assertNotEqual(ephemeral("child:%s:%s", a, 7), e)
+    self.assertEqual(name(e), "child:test 0:7")
+    release(e)
+    self.assertEqual(name(e), e)
+    self.assertEqual(name("not registered"), "not registered")
+
+  def test_ephemeral_threads(self):
+    import threading
+    pids = [[] for i in range(4)]
+    def make(out):
+      for i in range(10000):
+        out.append(ephemeral("child:%s", i))
+    threads = [threading.Thread(target=make, args=(p,)) for p in pids]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(len(set(sum(pids, []))), 40000)
+
+if __name__ == "__main__":
+  ut.main()
@@ -1,57 +1,365 @@
+import unittest as ut
 from process import Process
 from message import ProposeMessage,DecisionMessage,RequestMessage
+from message import CheckpointMessage,CatchupMessage
+from message import ReadMessage,ReadIndexMessage,ReadIndexReplyMessage
+from message import ReadRejectMessage
+from message import ResponseMessage
+from decisionlog import DecisionLog
+from statemachine import KVStore
 from utils import *
-import time
+from collections import OrderedDict
+import registry
 
 class Replica(Process):
-  def __init__(self, env, id, config):
+  def __init__(self, env, id, config,
+               batch_size=REQUESTBATCH, batch_delay=REQUESTDELAY,
+               checkpoint_interval=CHECKPOINTINTERVAL, logdir=None,
+               state=None):
     Process.__init__(self, env, id)
     self.slot_in = self.slot_out = 1
     self.proposals = {}
     self.decisions = {}
+    self.executed = RequestIndex()
+    # The application the commands run against
+    self.state = state if state is not None else KVStore()
+    # The last RESPONSECACHE responses to each client, to answer again
+    # when a client retries a command that was already performed.
+    # No responses are sent while the log is replayed.
+    self.responses = {} # client -> OrderedDict of req_id -> result
+    self.responding = True
     self.requests = []
+    # Up to batch_size requests are proposed together in one slot. A
+    # partial batch is held back until its oldest request has waited
+    # batch_delay seconds.
+    self.batch_size = batch_size
+    self.batch_delay = batch_delay
+    self.batch_deadline = None
+    # Every checkpoint_interval slots the replica snapshots its state
+    # and drops the decisions it no longer needs. With a log, the
+    # snapshot is saved with it and a restart begins from there.
+    self.checkpoint_interval = checkpoint_interval
+    self.checkpoint = (0, RequestIndex(), self.state.snapshot())
+    self.truncated = 1
+    # With a log, every executed decision is also written to disk so
+    # the replica can restart from it.
+    self.log = None
+    if logdir is not None:
+      self.log = DecisionLog(logdir)
+    # Reads are not proposed. The replica asks the leaders up to which
+    # slot it has to execute first, and then serves them on its own.
+    # If the leaders have no leases, reads go through the log instead.
+    self.read_id = 0
+    self.unindexed = []  # reads for which no read index was asked yet
+    self.indexing = {}   # read_id -> (time asked, reads waiting for it)
+    self.indexed = []    # (read index, reads) waiting to be served
+    # A replica that waits RESEND seconds for the decision of slot_out
+    # proposes its commands again and asks the other replicas and the
+    # leaders for the decisions it missed, as messages may be lost.
+    self.slot_seen = 0   # highest slot of a decision received
+    self.resend_at = None
     self.config = config
     self.env.addProc(self)
 
+  def request(self, cmd):
+    if isinstance(cmd, BatchCommand):
+      self.requests.extend(cmd.commands)
+    else:
+      self.requests.append(cmd)
+    if self.batch_deadline is None:
+      self.batch_deadline = self.clock() + self.batch_delay
+
+  def nextBatch(self):
+    # Reconfiguration commands are always proposed on their own.
+    if isinstance(self.requests[0], ReconfigCommand):
+      return self.requests.pop(0)
+    n = 1
+    while n < min(self.batch_size, len(self.requests)) and \
+          not isinstance(self.requests[n], ReconfigCommand):
+      n += 1
+    cmds = self.requests[:n]
+    del self.requests[:n]
+    if len(cmds) == 1:
+      return cmds[0]
+    return BatchCommand(tuple(cmds))
+
+  def configure(self):
+    if self.slot_in > WINDOW and self.slot_in-WINDOW in self.decisions:
+      if isinstance(self.decisions[self.slot_in-WINDOW],ReconfigCommand):
+        r,a,l = self.decisions[self.slot_in-WINDOW].config.split(';')
+        self.config = Config([registry.lookup(p) for p in r.split(',')],
+                             [registry.lookup(p) for p in a.split(',')],
+                             [registry.lookup(p) for p in l.split(',')])
+        print(registry.name(self.id), ": new config:", self.config)
+
   def propose(self):
     while len(self.requests) != 0 and self.slot_in < self.slot_out+WINDOW:
-      if self.slot_in > WINDOW and self.slot_in-WINDOW in self.decisions:
-        if isinstance(self.decisions[self.slot_in-WINDOW],ReconfigCommand):
-          r,a,l = self.decisions[self.slot_in-WINDOW].config.split(';')
-          self.config = Config(r.split(','),a.split(','),l.split(','))
-          print(self.id, ": new config:", self.config)
+      self.configure()
       if self.slot_in not in self.decisions:
-        cmd = self.requests.pop(0)
+        if len(self.requests) < self.batch_size and \
+              self.clock() < self.batch_deadline:
+          break
+        cmd = self.nextBatch()
         self.proposals[self.slot_in] = cmd
         for ldr in self.config.leaders:
           self.sendMessage(ldr, ProposeMessage(self.id,self.slot_in,cmd))
       self.slot_in +=1
+    if len(self.requests) == 0:
+      self.batch_deadline = None
 
   def perform(self, cmd):
-    for s in range(1, self.slot_out):
-      if self.decisions[s] == cmd:
-        self.slot_out += 1
-        return
-    if isinstance(cmd, ReconfigCommand):
-      self.slot_out += 1
-      return
-    print(self.id, ": perform",self.slot_out, ":", cmd)
+    # Returns the client commands in cmd that were not performed before.
+    # Their operations are applied by the caller.
+    performed = []
+    for c in cmd.commands if isinstance(cmd, BatchCommand) else (cmd,):
+      if isinstance(c, ReconfigCommand):
+        continue
+      # Reads only end up here without leases. They have negative
+      # req_ids, are not kept in the request index and may run twice.
+      if c.req_id >= 0:
+        if c in self.executed:
+          self.respondAgain(c)
+          continue
+        self.executed.add(c)
+      performed.append(c)
+      print(registry.name(self.id), ": perform",self.slot_out, ":", c)
     self.slot_out += 1
+    return performed
+
+  def apply(self, cmds):
+    if cmds:
+      results = self.state.apply_batch([c.op for c in cmds])
+      for c, result in zip(cmds, results):
+        self.respond(c, result)
+
+  def respond(self, cmd, result):
+    if cmd.client not in self.responses:
+      self.responses[cmd.client] = OrderedDict()
+    cache = self.responses[cmd.client]
+    cache[cmd.req_id] = result
+    if len(cache) > RESPONSECACHE:
+      cache.popitem(last=False)
+    if self.responding:
+      self.sendMessage(cmd.client, ResponseMessage(self.id, cmd.req_id, result))
+
+  def respondAgain(self, cmd):
+    cache = self.responses.get(cmd.client)
+    if self.responding and cache is not None and cmd.req_id in cache:
+      self.sendMessage(cmd.client,
+                       ResponseMessage(self.id, cmd.req_id, cache[cmd.req_id]))
 
-  def body(self):
-    print("Here I am: ", self.id)
+  def read(self, cmd):
+    result = self.state.read(cmd.op)
+    print(registry.name(self.id), ": read", self.slot_out-1, ":", cmd,
+          "->", result)
+    self.sendMessage(cmd.client, ResponseMessage(self.id, cmd.req_id, result))
+
+  def askReadIndex(self):
+    self.read_id += 1
+    self.indexing[self.read_id] = (self.clock(), self.unindexed)
+    self.unindexed = []
+    for ldr in self.config.leaders:
+      self.sendMessage(ldr, ReadIndexMessage(self.id, self.read_id))
+
+  def askReadIndexAgain(self):
+    # The question or its answer may have been lost, or the leader that
+    # had it failed.
+    now = self.clock()
+    for read_id, (asked, cmds) in list(self.indexing.items()):
+      if now - asked >= READINDEXTIMEOUT:
+        self.indexing[read_id] = (now, cmds)
+        for ldr in self.config.leaders:
+          self.sendMessage(ldr, ReadIndexMessage(self.id, read_id))
+
+  def serveReads(self):
+    waiting = []
+    for index, cmds in self.indexed:
+      if index < self.slot_out:
+        for cmd in cmds:
+          self.read(cmd)
+      else:
+        waiting.append((index, cmds))
+    self.indexed = waiting
+
+  def takeCheckpoint(self):
+    slot = self.slot_out-1
+    self.checkpoint = (slot, self.executed.copy(), self.state.snapshot())
+    # Move slot_in past the decided slots so that every reconfiguration
+    # up to here has been seen. Only the last WINDOW decisions are
+    # still needed to learn the configuration of the next slots.
+    while self.slot_in < self.slot_out:
+      self.configure()
+      self.slot_in += 1
+    while self.truncated <= slot and self.truncated < self.slot_in-WINDOW:
+      del self.decisions[self.truncated]
+      self.truncated += 1
+    if self.log is not None:
+      self.log.sync()
+      self.log.save_snapshot(self.checkpoint + (self.config, self.responses))
+    for ldr in self.config.leaders:
+      self.sendMessage(ldr, CheckpointMessage(self.id, slot))
+
+  def execute(self):
+    # The commands of all decided slots in a row are applied together.
+    cmds = []
+    while self.slot_out in self.decisions:
+      if self.log is not None and self.log.next_slot == self.slot_out:
+        self.log.append(self.slot_out, self.decisions[self.slot_out])
+      if self.slot_out in self.proposals:
+        if self.proposals[self.slot_out]!=self.decisions[self.slot_out]:
+          self.request(self.proposals[self.slot_out])
+        del self.proposals[self.slot_out]
+      cmds.extend(self.perform(self.decisions[self.slot_out]))
+      self.resend_at = None
+      if (self.slot_out-1) % self.checkpoint_interval == 0:
+        self.apply(cmds)
+        cmds = []
+        self.takeCheckpoint()
+    self.apply(cmds)
+
+  def waiting(self):
+    # Whether a decision for slot_out is due
+    return self.slot_in > self.slot_out or self.slot_seen >= self.slot_out
+
+  def catchUp(self):
+    for sn in range(self.slot_out, self.slot_in):
+      if sn in self.proposals and sn not in self.decisions:
+        for ldr in self.config.leaders:
+          self.sendMessage(ldr, ProposeMessage(self.id, sn,
+                                               self.proposals[sn]))
+    for p in self.config.replicas + self.config.leaders:
+      if p != self.id:
+        self.sendMessage(p, CatchupMessage(self.id, self.slot_out))
+
+  def recover(self):
+    # Restore the last snapshot and execute the logged decisions after
+    # it again to rebuild the state, then ask the other replicas for the
+    # decisions made while this one was down.
+    self.responding = False
+    snapshot = self.log.load_snapshot()
+    if snapshot is not None:
+      slot, executed, state, self.config, self.responses = snapshot
+      self.state.restore(state)
+      self.executed = executed.copy()
+      self.checkpoint = (slot, executed, state)
+      self.slot_in = self.slot_out = slot+1
+      # configure() looks back WINDOW slots.
+      self.truncated = max(1, self.slot_in-WINDOW)
+      self.decisions.update(self.log.replay(self.truncated, self.slot_in))
+    for slot, cmd in self.log.replay(self.slot_out):
+      self.decisions[slot] = cmd
+      if slot % self.checkpoint_interval == 0:
+        self.execute()
+    self.execute()
+    self.responding = True
+    for r in self.config.replicas:
+      if r != self.id:
+        self.sendMessage(r, CatchupMessage(self.id, self.slot_out))
+
+  def history(self, start):
+    if self.log is not None:
+      return self.log.replay(start, self.slot_out)
+    return [(s, self.decisions[s])
+            for s in range(max(start, self.truncated), self.slot_out)]
+
+  async def body(self):
+    print("Here I am: ", registry.name(self.id))
+    if self.log is not None:
+      self.recover()
     while True:
-      msg = self.getNextMessage()
-      if isinstance(msg, RequestMessage):
-        self.requests.append(msg.command)
+      timeout = None
+      if 0 < len(self.requests) < self.batch_size and \
+            self.slot_in < self.slot_out+WINDOW:
+        timeout = max(0, self.batch_deadline - self.clock())
+      if self.indexing:
+        asked = min(asked for asked, cmds in self.indexing.values())
+        wait = max(0, asked + READINDEXTIMEOUT - self.clock())
+        timeout = wait if timeout is None else min(timeout, wait)
+      if self.resend_at is not None:
+        wait = max(0, self.resend_at - self.clock())
+        timeout = wait if timeout is None else min(timeout, wait)
+      msg = await self.getNextMessage(timeout)
+      if msg is None:
+        pass
+      elif isinstance(msg, RequestMessage):
+        self.request(msg.command)
+      elif isinstance(msg, ReadMessage):
+        self.unindexed.append(msg.command)
+      elif isinstance(msg, ReadIndexReplyMessage):
+        if msg.read_id in self.indexing:
+          self.indexed.append((msg.slot_number,
+                               self.indexing.pop(msg.read_id)[1]))
+      elif isinstance(msg, ReadRejectMessage):
+        if msg.read_id in self.indexing:
+          for cmd in self.indexing.pop(msg.read_id)[1]:
+            self.request(cmd)
       elif isinstance(msg, DecisionMessage):
-        self.decisions[msg.slot_number] = msg.command
-        while self.slot_out in self.decisions:
-          if self.slot_out in self.proposals:
-            if self.proposals[self.slot_out]!=self.decisions[self.slot_out]:
-              self.requests.append(self.proposals[self.slot_out])
-            del self.proposals[self.slot_out]
-          self.perform(self.decisions[self.slot_out])
+        if msg.slot_number >= self.slot_out:
+          self.decisions[msg.slot_number] = msg.command
+          self.slot_seen = max(self.slot_seen, msg.slot_number)
+        self.execute()
+      elif isinstance(msg, CatchupMessage):
+        for slot, cmd in self.history(msg.slot_number):
+          self.sendMessage(msg.src, DecisionMessage(self.id, slot, cmd))
       else:
         print("Replica: unknown msg type")
       self.propose()
+      if self.unindexed:
+        self.askReadIndex()
+      if self.indexing:
+        self.askReadIndexAgain()
+      if self.indexed:
+        self.serveReads()
+      if not self.waiting():
+        self.resend_at = None
+      elif self.resend_at is None:
+        self.resend_at = self.clock() + RESEND
+      elif self.clock() >= self.resend_at:
+        self.catchUp()
+        self.resend_at = self.clock() + RESEND
+
+
+class test_replica(ut.TestCase):
+  def test_checkpoints(self):
+    # Acceptors and leaders drop the slots every replica checkpointed,
+    # and a new leader does not ask for them again.
+    import io, contextlib
+    from message import P1bMessage
+    from sim import SimEnv, cluster
+    class TracingEnv(SimEnv):
+      def sendMessage(self, dst, msg):
+        if isinstance(msg, P1bMessage):
+          self.p1bs.append((self.now, msg))
+        SimEnv.sendMessage(self, dst, msg)
+    env = TracingEnv(1, jitter=0.002)
+    env.p1bs = []
+    def submit(start, n):
+      for i in range(start, start+n):
+        cmd = Command("client", i, ("put", "k%d" % (i % 7), i))
+        for r in config.replicas:
+          env.at(env.now + (i-start) * 0.001, env.arrive, r,
+                 RequestMessage("client", cmd))
+    with contextlib.redirect_stdout(io.StringIO()):
+      config, replicas, acceptors, leaders = \
+        cluster(env, checkpoint_interval=5, batch_size=1)
+      submit(0, 50)
+      env.run(until=2)
+      checkpoint = min(a.checkpoint for a in acceptors)
+      active = [l for l in leaders if l.active]
+      self.assertEqual(len(active), 1)
+      env.crash(active[0].id)
+      crashed = env.now
+      submit(50, 20)
+      env.run(until=6)
+    self.assertGreaterEqual(checkpoint, 40)
+    for a in acceptors:
+      self.assertTrue(all(pv.slot_number > a.checkpoint for pv in a.accepted))
+    p1bs = [msg for t, msg in env.p1bs if t > crashed]
+    self.assertTrue(p1bs)
+    for msg in p1bs:
+      self.assertTrue(all(pv.slot_number > checkpoint for pv in msg.accepted))
+    a, b = replicas
+    self.assertEqual(a.slot_out, b.slot_out)
+    self.assertEqual(a.state.data, b.state.data)
+    for i in range(70):
+      self.assertIn(Command("client", i, None), a.executed)
@@ -0,0 +1,417 @@
+import os
+import platform
+import select
+import struct
+import threading
+import time
+import unittest as ut
+from collections import deque
+from multiprocessing import shared_memory
+from codec import Encoder, Decoder
+
+RINGSIZE = 1 << 20  # Bytes of messages a ring holds
+POLL = 0.01         # Seconds a node sleeps at most between looks at its rings
+GONE = 2.0          # Seconds a ring may stay full before messages for
+                    # it are dropped until it has room again
+
+HEAD, TAIL, CAPACITY = range(3) # Fields of the header, 8 bytes each
+HEADER = 3*8
+LENGTH = struct.Struct("I")
+
+class Ring:
+  """
+  A queue of byte strings in shared memory, written by one process and
+  read by another. head and tail count the bytes ever written and
+  read; only the writer moves head and only the reader moves tail, so
+  neither needs a lock. Every record is a 4-byte length and a payload,
+  either of which may wrap around the end of the buffer.
+
+  The header is accessed as an array of 8-byte integers, which are
+  stored in one go. struct.pack_into() would clear a field before
+  filling it in, and the other process could read it in between.
+
+  Python has no memory barriers, so the ring relies on the CPU to make
+  stores visible to other cores in the order they were made: the
+  writer stores a record before it moves head, and the reader must not
+  see the new head before the record. x86 guarantees that; weakly
+  ordered CPUs such as ARM do not, and RingFabric refuses to run there.
+  """
+  def __init__(self, name, capacity=RINGSIZE, create=False):
+    if create:
+      self.shm = shared_memory.SharedMemory(name, True, HEADER+capacity)
+    else:
+      self.shm = shared_memory.SharedMemory(name)
+    self.buf = self.shm.buf
+    self.header = self.buf[:HEADER].cast("Q")
+    if create:
+      self.header[CAPACITY] = capacity
+    self.capacity = self.header[CAPACITY]
+    self.taken = 0  # bytes of the record get() returned last
+
+  def write(self, pos, data):
+    start = HEADER + pos % self.capacity
+    n = min(len(data), HEADER + self.capacity - start)
+    self.buf[start:start+n] = data[:n]
+    if n < len(data):
+      self.buf[HEADER:HEADER+len(data)-n] = data[n:]
+
+  def read(self, pos, n):
+    # A view of the buffer, unless the bytes wrap around its end
+    start = HEADER + pos % self.capacity
+    end = start + n
+    if end <= HEADER + self.capacity:
+      return self.buf[start:end]
+    wrapped = end - HEADER - self.capacity
+    return bytes(self.buf[start:HEADER+self.capacity]) + \
+           bytes(self.buf[HEADER:HEADER+wrapped])
+
+  def put(self, payload):
+    """
+    Appends payload. Returns None if there is no room for it, else
+    whether the ring was empty, in which case the reader may be asleep.
+    """
+    head, tail = self.header[HEAD], self.header[TAIL]
+    n = LENGTH.size + len(payload)
+    if n > self.capacity:
+      raise ValueError("message of %d bytes does not fit a ring" % n)
+    if self.capacity - (head - tail) < n:
+      return None
+    self.write(head, LENGTH.pack(len(payload)))
+    self.write(head + LENGTH.size, payload)
+    self.header[HEAD] = head + n
+    return head == tail
+
+  def get(self):
+    """
+    Returns the oldest payload, or None if the ring is empty. The
+    payload may be a view of the ring, so it has to be used up before
+    release() lets the writer reuse its bytes.
+    """
+    head, tail = self.header[HEAD], self.header[TAIL]
+    if head == tail:
+      return None
+    n = LENGTH.unpack(bytes(self.read(tail, LENGTH.size)))[0]
+    self.taken = LENGTH.size + n
+    return self.read(tail + LENGTH.size, n)
+
+  def release(self):
+    self.header[TAIL] += self.taken
+
+  def close(self):
+    self.header.release()
+    self.buf = None
+    self.shm.close()
+
+def ringName(nodes, src, dst):
+  # Rings are named after the directory of the nodes' doorbells, which
+  # is unique to one launch.
+  directory = os.path.basename(os.path.dirname(nodes[dst]))
+  return "%s.%d.%d" % (directory, src, dst)
+
+def unlink(nodes):
+  """
+  Removes the rings of all nodes, which outlive the processes that
+  made them.
+  """
+  for dst in range(len(nodes)):
+    for src in range(len(nodes)):
+      if src != dst:
+        try:
+          shared_memory.SharedMemory(ringName(nodes, src, dst)).unlink()
+        except FileNotFoundError:
+          pass
+
+class Outgoing:
+  # The ring to one other node and the messages for it that wait for
+  # the node to set up its rings or for room in the ring. The next one
+  # to go is already encoded.
+  def __init__(self, node):
+    self.node = node
+    self.ring = None
+    self.bell = None
+    self.encoder = None
+    self.pending = deque()
+    self.payload = None
+    self.full_since = None
+    self.gone = False
+    self.lock = threading.Lock()
+
+class RingFabric:
+  """
+  Carries messages between nodes that run as OS processes on the same
+  host, like Transport, through shared memory rather than sockets. Each
+  node owns one Ring for every other node, which only that node writes
+  to, and a doorbell: a named pipe, at the node's address, that a
+  writer rings when it puts a message into an empty ring. A node reads
+  its rings on a thread of its own that sleeps on the doorbell when all
+  rings are empty. Messages are encoded with codec.Encoder and decoded
+  straight from the ring.
+
+  A writer only rings the bell when it finds the ring empty, so the
+  two processes can miss each other when their CPUs reorder the
+  accesses to head and tail; the reader therefore never sleeps longer
+  than POLL seconds, which is then how late such a message arrives.
+
+  The nodes are the addresses of the doorbells, all in one directory.
+  Messages for a node are kept back until the node has made its rings,
+  and while its ring is full; the receive thread tries to pass them on
+  again, so a sender never waits. Once a ring has been full for GONE
+  seconds, the messages for it are dropped until it has room again, as
+  Transport drops them while it reconnects; Paxos sends again what is
+  lost. Only a node that has exited is given up for good.
+  """
+  def __init__(self, env, address):
+    if platform.machine() not in ("x86_64", "AMD64", "i386", "i686"):
+      raise RuntimeError("shared-memory rings need the store order of x86")
+    self.env = env
+    self.nodes = env.nodes
+    self.node = self.nodes.index(address)
+    self.routes = {}   # process id -> index of the node hosting it
+    self.outgoing = {} # node index -> Outgoing
+    self.incoming = [] # (node index, Ring, Decoder)
+    self.closed = False
+
+  def start(self):
+    for src in range(len(self.nodes)):
+      if src != self.node:
+        ring = Ring(ringName(self.nodes, src, self.node), create=True)
+        self.incoming.append((src, ring, Decoder()))
+    address = self.nodes[self.node]
+    os.mkfifo(address)
+    # Opened for writing too, so the pipe never reads as closed.
+    self.bell = os.open(address, os.O_RDWR | os.O_NONBLOCK)
+    self.receiver = threading.Thread(target=self.receive, daemon=True)
+    self.receiver.start()
+
+  def close(self):
+    """
+    Stops the receive thread and lets go of the rings and doorbells.
+    """
+    self.closed = True
+    os.write(self.bell, b"\0")
+    self.receiver.join()
+    for out in self.outgoing.values():
+      if out.ring is not None:
+        out.ring.close()
+        os.close(out.bell)
+    for src, ring, decoder in self.incoming:
+      ring.close()
+    os.close(self.bell)
+    os.unlink(self.nodes[self.node])
+
+  def route(self, pid, address):
+    self.routes[pid] = self.nodes.index(address)
+
+  def send(self, dst, msg):
+    node = self.routes.get(dst)
+    if node is None:
+      return
+    out = self.outgoing.get(node)
+    if out is None:
+      out = self.outgoing.setdefault(node, Outgoing(node))
+    with out.lock:
+      out.pending.append((dst, msg))
+      self.flush(out)
+
+  def attach(self, out):
+    try:
+      out.bell = os.open(self.nodes[out.node], os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+      return False
+    out.ring = Ring(ringName(self.nodes, self.node, out.node))
+    out.encoder = Encoder()
+    return True
+
+  def flush(self, out):
+    # Called with out.lock held. Passes on as many messages as fit.
+    if out.ring is None and not self.attach(out):
+      return
+    while not out.gone:
+      # A message is only encoded when it goes next, and then kept
+      # until it is in the ring: the encoder interns strings for the
+      # decoder at the other end, which has to see every encoding.
+      if out.payload is None:
+        if not out.pending:
+          break
+        dst, msg = out.pending.popleft()
+        out.payload = out.encoder.encode(msg, dst)
+      empty = out.ring.put(out.payload)
+      if empty is None:
+        # Full: wake the reader, and drop what waits for it once it
+        # stalled for GONE seconds.
+        now = time.monotonic()
+        if out.full_since is None:
+          out.full_since = now
+        elif now - out.full_since > GONE:
+          out.pending.clear()
+        self.ring(out)
+        break
+      out.payload = None
+      out.full_since = None
+      if empty:
+        self.ring(out)
+    if out.gone:
+      out.pending.clear()
+      out.payload = None
+
+  def ring(self, out):
+    try:
+      os.write(out.bell, b"\0")
+    except BrokenPipeError:
+      out.gone = True # Nobody has the pipe open for reading any more.
+    except OSError:
+      pass # The pipe is full of rings already.
+
+  def receive(self):
+    procs = self.env.procs
+    while not self.closed:
+      received = False
+      for src, ring, decoder in self.incoming:
+        while True:
+          payload = ring.get()
+          if payload is None:
+            break
+          dst, msg = decoder.decode(payload, True)
+          decoder.data = b""
+          payload = None
+          ring.release()
+          received = True
+          if msg.src not in procs:
+            self.routes[msg.src] = src
+          if dst in procs:
+            procs[dst].deliver(msg)
+      if received:
+        continue
+      for out in list(self.outgoing.values()):
+        if out.ring is None or out.payload is not None:
+          with out.lock:
+            self.flush(out)
+      select.select([self.bell], [], [], POLL)
+      try:
+        os.read(self.bell, 4096)
+      except BlockingIOError:
+        pass
+
+
+class test_ring(ut.TestCase):
+  def setUp(self):
+    self.name = "paxos-test-%d" % os.getpid()
+    self.writer = Ring(self.name, 64, create=True)
+    self.reader = Ring(self.name)
+
+  def tearDown(self):
+    self.reader.close()
+    self.writer.close()
+    self.writer.shm.unlink()
+
+  def test_order_and_wrap(self):
+    sent = [bytes([i]) * (i % 20) for i in range(100)]
+    received = []
+    for payload in sent:
+      while self.writer.put(payload) is None:
+        received.append(bytes(self.reader.get()))
+        self.reader.release()
+    while True:
+      payload = self.reader.get()
+      if payload is None:
+        break
+      received.append(bytes(payload))
+      self.reader.release()
+    self.assertEqual(received, sent)
+
+  def test_empty_and_full(self):
+    self.assertIsNone(self.reader.get())
+    self.assertTrue(self.writer.put(b"x" * 20))
+    self.assertFalse(self.writer.put(b"x" * 20))
+    self.assertIsNone(self.writer.put(b"x" * 20))
+    self.assertRaises(ValueError, self.writer.put, b"x" * 64)
+
+class test_fabric(ut.TestCase):
+  class Node:
+    def __init__(self, nodes, node, pids):
+      import queue
+      self.nodes = nodes
+      self.procs = {pid: self for pid in pids}
+      self.inbox = queue.SimpleQueue()
+      self.fabric = RingFabric(self, nodes[node])
+
+    def deliver(self, msg):
+      self.inbox.put(msg)
+
+  def setUp(self):
+    import shutil, tempfile
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    self.nodes = [os.path.join(directory, "node%d" % i) for i in range(2)]
+    self.addCleanup(unlink, self.nodes)
+    self.a = self.Node(self.nodes, 0, ["a"])
+    self.b = self.Node(self.nodes, 1, ["b"])
+    self.a.fabric.route("b", self.nodes[1])
+
+  def send(self, node, src, dst, i):
+    from message import RequestMessage
+    from utils import Command
+    node.fabric.send(dst, RequestMessage(src, Command(src, i, "op " * 20)))
+
+  def test_send_and_reply(self):
+    a, b = self.a, self.b
+    # Sent before b has made its rings
+    self.send(a, "a", "b", 0)
+    a.fabric.start()
+    b.fabric.start()
+    self.addCleanup(a.fabric.close)
+    self.addCleanup(b.fabric.close)
+    # More than fit into a ring at once
+    for i in range(1, 20000):
+      self.send(a, "a", "b", i)
+    received = [b.inbox.get(timeout=5) for i in range(20000)]
+    self.assertEqual([m.command.req_id for m in received], list(range(20000)))
+    self.send(b, "b", "a", 0)
+    self.assertEqual(a.inbox.get(timeout=5).src, "b")
+
+  def test_reader_gone(self):
+    a, b = self.a, self.b
+    a.fabric.start()
+    b.fabric.start()
+    self.addCleanup(a.fabric.close)
+    self.send(a, "a", "b", 0)
+    b.inbox.get(timeout=5)
+    b.fabric.close()
+    # Neither blocks nor keeps the messages once b is gone.
+    start = time.monotonic()
+    for i in range(1, 20000):
+      self.send(a, "a", "b", i)
+    self.assertLess(time.monotonic() - start, GONE)
+    out = a.fabric.outgoing[1]
+    self.assertTrue(out.gone)
+    self.assertFalse(out.pending)
+
+  def test_reader_stalls(self):
+    a, b = self.a, self.b
+    a.fabric.start()
+    b.fabric.start()
+    self.addCleanup(a.fabric.close)
+    self.addCleanup(b.fabric.close)
+    # b takes the first message and then stops reading for a while.
+    stalled = threading.Event()
+    def deliver(msg):
+      stalled.wait()
+      b.inbox.put(msg)
+    b.deliver = deliver
+    for i in range(20000):
+      self.send(a, "a", "b", i)
+    time.sleep(GONE + 0.5)
+    self.send(a, "a", "b", 20000)
+    stalled.set()
+    # What waited more than GONE is lost, but later messages arrive.
+    time.sleep(0.5)
+    self.send(a, "a", "b", 20001)
+    received = []
+    while not received or received[-1] != 20001:
+      received.append(b.inbox.get(timeout=5).command.req_id)
+    self.assertEqual(received, sorted(received))
+    self.assertLess(len(received), 20000)
+    self.assertFalse(a.fabric.outgoing[1].gone)
+
+if __name__ == "__main__":
+  ut.main()
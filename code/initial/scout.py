@@ -1,24 +1,48 @@
 from process import Process
+from pvalueset import PValueSet
 from message import P1aMessage,P1bMessage,PreemptedMessage,AdoptedMessage
+from utils import RESEND,THRIFTY,preferred
 
 class Scout(Process):
-  def __init__(self, env, id, leader, acceptors, ballot_number):
+  ephemeral = True
+
+  def __init__(self, env, id, leader, acceptors, ballot_number, slot_number,
+               thrifty=THRIFTY):
     Process.__init__(self, env, id)
     self.leader = leader
     self.acceptors = acceptors
     self.ballot_number = ballot_number
+    self.slot_number = slot_number
+    self.thrifty = thrifty
     self.env.addProc(self)
 
-  def body(self):
-    waitfor = set()
-    for a in self.acceptors:
-      self.sendMessage(a, P1aMessage(self.id, self.ballot_number))
-      waitfor.add(a)
+  def ask(self, acceptors):
+    for a in acceptors:
+      self.sendMessage(a, P1aMessage(self.id, self.ballot_number,
+                                     self.slot_number))
+
+  async def body(self):
+    waitfor = set(self.acceptors)
+    if self.thrifty is None:
+      self.ask(self.acceptors)
+      deadline = self.clock() + RESEND
+    else:
+      # Ask a majority, another one in every round, and the others only
+      # if it does not answer within thrifty seconds.
+      self.ask(preferred(self.acceptors, self.ballot_number.round))
+      deadline = self.clock() + self.thrifty
 
-    pvalues = set()
+    pvalues = PValueSet()
     while True:
-      msg = self.getNextMessage()
-      if isinstance(msg, P1bMessage):
+      msg = await self.getNextMessage(max(0, deadline - self.clock()))
+      if self.clock() >= deadline:
+        # Ask every acceptor that has not answered, again if need be,
+        # as messages may be lost.
+        self.ask([a for a in self.acceptors if a in waitfor])
+        deadline = self.clock() + RESEND
+      if msg is None:
+        pass
+      elif isinstance(msg, P1bMessage):
         if self.ballot_number == msg.ballot_number and msg.src in waitfor:
           pvalues.update(msg.accepted)
           waitfor.remove(msg.src)
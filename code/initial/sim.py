@@ -0,0 +1,212 @@
+import heapq
+import itertools
+import random
+import unittest as ut
+from collections import deque
+from env import Env
+
+class SimInbox:
+  """
+  The inbox of a process in a simulation. It also holds the body of
+  the process, which the simulator runs until it awaits a message that
+  has not arrived; a message arriving or the timeout expiring in
+  simulated time runs it again.
+  """
+  def __init__(self, env, proc):
+    self.env = env
+    self.proc = proc
+    self.body = None
+    self.messages = deque()
+    self.receive = None  # what the body awaits while it is waiting
+    self.wait_id = 0
+    self.alive = True
+
+  def put(self, msg):
+    self.messages.append(msg)
+    if self.receive is not None:
+      self.env.resume(self, self.messages.popleft())
+
+  def expire(self, wait_id):
+    if self.receive is not None and wait_id == self.wait_id:
+      self.env.resume(self, None)
+
+class SimEnv(Env):
+  """
+  Runs processes under a simulated clock, as coroutines on the calling
+  thread rather than on threads of their own. Exactly one process runs
+  at a time, until it awaits its next message; the simulator then
+  advances the clock to the next event, such as a message arriving or
+  a timeout expiring, and runs the process the event is for. With the
+  same seed, a run makes the same choices and delivers the same
+  messages in the same order, no matter how long it takes in real
+  time.
+
+  Every message is delayed by latency plus a random share of jitter,
+  so messages with jitter get reordered, and is lost with probability
+  drop. crash() stops a process and everything it spawned.
+  """
+  def __init__(self, seed=0, latency=0.001, jitter=0.0, drop=0.0):
+    Env.__init__(self)
+    self.random = random.Random(seed)
+    self.latency = latency
+    self.jitter = jitter
+    self.drop = drop
+    self.now = 0.0
+    self.events = []
+    self.counter = itertools.count()
+    self.current = None
+    self.parent = {}  # pid -> pid of the process that created it
+    self.sent = self.delivered = self.dropped = 0
+
+  def clock(self):
+    return self.now
+
+  def at(self, when, callback, *args):
+    heapq.heappush(self.events, (when, next(self.counter), callback, args))
+
+  def after(self, delay, callback, *args):
+    self.at(self.now + delay, callback, *args)
+
+  def addProc(self, proc):
+    proc.inbox = SimInbox(self, proc)
+    self.procs[proc.id] = proc
+    self.parent[proc.id] = self.current
+    self.after(0, self.start, proc)
+
+  def start(self, proc):
+    if proc.inbox.alive:
+      proc.inbox.body = proc.body()
+      self.resume(proc.inbox, None)
+
+  def resume(self, inbox, msg):
+    # Runs the body of inbox's process until it awaits a message that
+    # has not arrived yet.
+    if not inbox.alive:
+      return
+    inbox.receive = None
+    self.current = inbox.proc.id
+    try:
+      receive = inbox.body.send(msg)
+      while inbox.messages or \
+            (receive.timeout is not None and receive.timeout <= 0):
+        if inbox.messages:
+          receive = inbox.body.send(inbox.messages.popleft())
+        else:
+          receive = inbox.body.send(None)
+    except StopIteration:
+      self.removeProc(inbox.proc.id)
+      return
+    finally:
+      self.current = None
+    inbox.receive = receive
+    inbox.wait_id += 1
+    if receive.timeout is not None:
+      self.after(receive.timeout, inbox.expire, inbox.wait_id)
+
+  def sendMessage(self, dst, msg):
+    self.sent += 1
+    if self.drop and self.random.random() < self.drop:
+      self.dropped += 1
+      return
+    delay = self.latency
+    if self.jitter:
+      delay += self.random.random() * self.jitter
+    self.after(delay, self.arrive, dst, msg)
+
+  def arrive(self, dst, msg):
+    if dst in self.procs:
+      self.delivered += 1
+      self.procs[dst].deliver(msg)
+
+  def crash(self, pid):
+    for child in [c for c, p in self.parent.items() if p == pid]:
+      self.crash(child)
+    proc = self.procs.pop(pid, None)
+    self.parent.pop(pid, None)
+    if proc is not None:
+      proc.inbox.alive = False
+
+  def removeProc(self, pid):
+    if pid in self.procs:
+      Env.removeProc(self, pid)
+    self.parent.pop(pid, None)
+
+  def run(self, until=None):
+    """
+    Handles events in order of time until there are none left or the
+    next one is due after until. Returns the number of events handled.
+    """
+    n = 0
+    while self.events:
+      if until is not None and self.events[0][0] > until:
+        self.now = until
+        break
+      when, i, callback, args = heapq.heappop(self.events)
+      self.now = when
+      callback(*args)
+      n += 1
+    return n
+
+def cluster(env, nreplicas=2, nacceptors=3, nleaders=2, **replica_options):
+  """
+  Creates the replicas, acceptors and leaders of a cluster in env, for
+  the tests of the modules that need a whole cluster to run. Returns
+  their Config and the lists of replicas, acceptors and leaders.
+  """
+  from acceptor import Acceptor
+  from leader import Leader
+  from replica import Replica
+  from utils import Config
+  config = Config([], [], [])
+  replicas = [Replica(env, "replica %d" % i, config, **replica_options)
+              for i in range(nreplicas)]
+  config.replicas.extend(r.id for r in replicas)
+  acceptors = [Acceptor(env, "acceptor %d" % i) for i in range(nacceptors)]
+  config.acceptors.extend(a.id for a in acceptors)
+  leaders = [Leader(env, "leader %d" % i, config) for i in range(nleaders)]
+  config.leaders.extend(l.id for l in leaders)
+  return config, replicas, acceptors, leaders
+
+
+class test_sim(ut.TestCase):
+  def run_cluster(self, seed, everywhere=False, **options):
+    # Sends each request to one replica, or to every replica as a
+    # client that retries would.
+    import io, contextlib
+    from message import RequestMessage
+    from utils import Command
+    env = SimEnv(seed, **options)
+    with contextlib.redirect_stdout(io.StringIO()):
+      config, replicas, acceptors, leaders = cluster(env)
+      for i in range(100):
+        cmd = Command("client", i, ("put", "k%d" % (i % 7), i))
+        for r in config.replicas if everywhere else [config.replicas[i % 2]]:
+          env.at(i * 0.001, env.arrive, r, RequestMessage("client", cmd))
+      env.run(until=10)
+    return env, replicas
+
+  def test_deterministic(self):
+    from utils import Command
+    a, ra = self.run_cluster(1, jitter=0.002)
+    b, rb = self.run_cluster(1, jitter=0.002)
+    self.assertEqual(a.sent, b.sent)
+    self.assertEqual(ra[0].decisions, rb[0].decisions)
+    self.assertEqual(ra[0].state.data, ra[1].state.data)
+    for i in range(100):
+      self.assertIn(Command("client", i, None), ra[0].executed)
+
+  def test_drops(self):
+    from utils import Command
+    for seed in range(1, 4):
+      env, replicas = self.run_cluster(seed, True, jitter=0.002, drop=0.05)
+      # Replicas that missed messages catch up.
+      self.assertGreater(env.dropped, 0)
+      a, b = replicas
+      self.assertEqual(a.slot_out, b.slot_out)
+      self.assertEqual(a.decisions, b.decisions)
+      self.assertEqual(a.state.data, b.state.data)
+      for i in range(100):
+        self.assertIn(Command("client", i, None), a.executed)
+
+if __name__ == "__main__":
+  ut.main()
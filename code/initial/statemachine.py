@@ -0,0 +1,105 @@
+import abc
+import unittest as ut
+
+class StateMachine(abc.ABC):
+  """
+  The application a replica runs. The replica applies the operations of
+  the decided commands in slot order, every operation exactly once, and
+  hands over all operations of a run of consecutive decided slots in
+  one apply_batch() call. Reads that need no consensus go to read(),
+  which must not change the state.
+
+  A replica with a log saves a snapshot() at every checkpoint and
+  restore()s the last one when it restarts, so snapshots have to be
+  picklable.
+  """
+  @abc.abstractmethod
+  def apply(self, op):
+    pass
+
+  def apply_batch(self, ops):
+    return [self.apply(op) for op in ops]
+
+  @abc.abstractmethod
+  def read(self, op):
+    pass
+
+  @abc.abstractmethod
+  def snapshot(self):
+    # A copy of the state that later operations do not change
+    pass
+
+  @abc.abstractmethod
+  def restore(self, snapshot):
+    pass
+
+class KVStore(StateMachine):
+  """
+  A key-value store. Operations are tuples:
+  - ("put", key, value) sets key and returns its previous value,
+  - ("delete", key) removes key and returns its previous value,
+  - ("get", key) returns the value of key.
+  Missing keys read as None. Any other operation leaves the store
+  unchanged and returns None.
+  """
+  def __init__(self):
+    self.data = {}
+
+  def apply(self, op):
+    return self.apply_batch((op,))[0]
+
+  def apply_batch(self, ops):
+    data = self.data
+    results = []
+    for op in ops:
+      if type(op) is not tuple or len(op) < 2:
+        results.append(None)
+      elif op[0] == "put" and len(op) == 3:
+        results.append(data.get(op[1]))
+        data[op[1]] = op[2]
+      elif op[0] == "get":
+        results.append(data.get(op[1]))
+      elif op[0] == "delete":
+        results.append(data.pop(op[1], None))
+      else:
+        results.append(None)
+    return results
+
+  def read(self, op):
+    if type(op) is tuple and len(op) == 2 and op[0] == "get":
+      return self.data.get(op[1])
+    return None
+
+  def snapshot(self):
+    return dict(self.data)
+
+  def restore(self, snapshot):
+    self.data = dict(snapshot)
+
+
+class test_kvstore(ut.TestCase):
+  def setUp(self):
+    self.kv = KVStore()
+
+  def test_apply(self):
+    self.assertEqual(self.kv.apply_batch([("put", "a", 1), ("put", "a", 2),
+                                          ("get", "a"), ("delete", "a"),
+                                          ("get", "a")]),
+                     [None, 1, 2, 2, None])
+    self.assertIsNone(self.kv.apply("operation 0.0"))
+
+  def test_read(self):
+    self.kv.apply(("put", "a", 1))
+    self.assertEqual(self.kv.read(("get", "a")), 1)
+    self.assertIsNone(self.kv.read(("put", "a", 2)))
+    self.assertEqual(self.kv.read(("get", "a")), 1)
+
+  def test_snapshot(self):
+    self.kv.apply(("put", "a", 1))
+    snapshot = self.kv.snapshot()
+    self.kv.apply(("put", "a", 2))
+    self.kv.restore(snapshot)
+    self.assertEqual(self.kv.read(("get", "a")), 1)
+
+if __name__ == "__main__":
+  ut.main()
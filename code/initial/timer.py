@@ -0,0 +1,77 @@
+# Started from backoff/timer.py, as no variant imports from another.
+import heapq
+import itertools
+import time
+import unittest as ut
+
+class Timer:
+  __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+  def __init__(self, when, callback, args):
+    self.when = when
+    self.callback = callback
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+class Scheduler:
+  """
+  The timers of one process, in a heap ordered by time. A process
+  blocks on its inbox for at most timeout() seconds and then calls
+  run() to fire the timers that are due, so it can delay an action
+  without delaying the messages it handles meanwhile.
+  """
+  def __init__(self, clock=time.monotonic):
+    self.clock = clock
+    self.heap = []
+    self.counter = itertools.count()
+
+  def schedule(self, delay, callback, *args):
+    timer = Timer(self.clock() + delay, callback, args)
+    heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+    return timer
+
+  def timeout(self):
+    # Seconds until the next timer is due, None if there is none.
+    while self.heap and self.heap[0][2].cancelled:
+      heapq.heappop(self.heap)
+    if not self.heap:
+      return None
+    return max(0, self.heap[0][0] - self.clock())
+
+  def run(self):
+    now = self.clock()
+    while self.heap and self.heap[0][0] <= now:
+      timer = heapq.heappop(self.heap)[2]
+      if not timer.cancelled:
+        timer.callback(*timer.args)
+
+
+class test_scheduler(ut.TestCase):
+  def setUp(self):
+    self.now = 0
+    self.fired = []
+    self.timer = Scheduler(lambda: self.now)
+
+  def test_order(self):
+    self.timer.schedule(2, self.fired.append, "b")
+    self.timer.schedule(1, self.fired.append, "a")
+    self.timer.schedule(2, self.fired.append, "c")
+    self.assertEqual(self.timer.timeout(), 1)
+    self.now = 2
+    self.timer.run()
+    self.assertEqual(self.fired, ["a", "b", "c"])
+    self.assertIsNone(self.timer.timeout())
+
+  def test_cancel(self):
+    self.timer.schedule(1, self.fired.append, "a").cancel()
+    self.timer.schedule(3, self.fired.append, "b")
+    self.assertEqual(self.timer.timeout(), 3)
+    self.now = 3
+    self.timer.run()
+    self.assertEqual(self.fired, ["b"])
+
+if __name__ == "__main__":
+  ut.main()
@@ -0,0 +1,228 @@
+import asyncio
+import pickle
+import queue
+import struct
+import threading
+import unittest as ut
+from collections import deque
+from codec import Encoder, Decoder, VERSION
+from message import RequestMessage
+from utils import Command
+
+RECONNECT = 0.1  # Seconds between attempts to (re)connect to a peer
+MAXQUEUED = 65536 # Messages kept for a peer; beyond that the oldest go
+
+FRAME = struct.Struct("!I")
+
+def addressText(address):
+  # Addresses are (host, port) for TCP or the path of a Unix socket.
+  if isinstance(address, str):
+    return "unix:" + address
+  return "%s:%d" % address
+
+def parseAddress(text):
+  if text.startswith("unix:"):
+    return text[len("unix:"):]
+  host, port = text.rsplit(":", 1)
+  return (host, int(port))
+
+async def connect(address):
+  if isinstance(address, str):
+    return await asyncio.open_unix_connection(address)
+  return await asyncio.open_connection(*address)
+
+def frame(payload):
+  return FRAME.pack(len(payload)) + payload
+
+async def readFrame(reader):
+  header = await reader.readexactly(FRAME.size)
+  return await reader.readexactly(FRAME.unpack(header)[0])
+
+class Peer:
+  # Messages waiting to be written to one other node. While the node
+  # cannot be reached only the last MAXQUEUED are kept; Paxos sends
+  # again what is lost. They are encoded as they are written, so that
+  # the decoder at the other end sees every string interned. A
+  # connection starts with a frame holding the wire format version
+  # and the address of the node that opened it.
+  def __init__(self, address):
+    self.address = address
+    self.messages = deque(maxlen=MAXQUEUED) # (destination, message)
+    self.ready = asyncio.Event()
+    self.encoder = Encoder()
+
+  def hello(self, address):
+    return frame(bytes([VERSION]) + addressText(address).encode())
+
+class Transport:
+  """
+  Carries messages between Envs that run in different OS processes or
+  on different hosts. Every node listens on its own address and keeps
+  one connection to each peer node it sends to. A frame is a 4-byte
+  length and a message encoded with codec.Encoder, preceded by its
+  destination; all frames queued for a peer while its previous write
+  was in flight go out in a single write.
+
+  A node on the same host can listen on a Unix socket instead, given
+  as a path rather than a (host, port) address, which spares the
+  messages the TCP/IP stack.
+
+  Messages are routed by process id. Routes to the long-lived
+  processes are set up front with route(); routes to the processes
+  that send us messages, such as scouts and commanders, are learned
+  from the address each connection announces when it opens.
+  """
+  def __init__(self, env, address):
+    self.env = env
+    self.address = address
+    self.routes = {} # process id -> address of the node hosting it
+    self.peers = {}  # address -> Peer
+    self.outgoing = []
+    self.scheduled = False
+    self.lock = threading.Lock()
+    self.loop = asyncio.new_event_loop()
+
+  def start(self):
+    listening = threading.Event()
+    def run():
+      asyncio.set_event_loop(self.loop)
+      self.loop.run_until_complete(self.listen())
+      listening.set()
+      self.loop.run_forever()
+    threading.Thread(target=run, daemon=True).start()
+    listening.wait()
+
+  async def listen(self):
+    if isinstance(self.address, str):
+      self.server = await asyncio.start_unix_server(self.serve, self.address)
+    else:
+      host, port = self.address
+      self.server = await asyncio.start_server(self.serve, host, port)
+
+  def route(self, pid, address):
+    self.routes[pid] = address
+
+  def send(self, dst, msg):
+    # Called from any thread. The event loop is only woken up for the
+    # first message of a burst; the rest ride along.
+    address = self.routes.get(dst)
+    if address is None:
+      return
+    with self.lock:
+      self.outgoing.append((address, dst, msg))
+      if self.scheduled:
+        return
+      self.scheduled = True
+    self.loop.call_soon_threadsafe(self.flush)
+
+  def flush(self):
+    with self.lock:
+      outgoing, self.outgoing = self.outgoing, []
+      self.scheduled = False
+    for address, dst, msg in outgoing:
+      if address not in self.peers:
+        self.peers[address] = Peer(address)
+        self.loop.create_task(self.write(self.peers[address]))
+      peer = self.peers[address]
+      peer.messages.append((dst, msg))
+      peer.ready.set()
+
+  async def write(self, peer):
+    while True:
+      try:
+        reader, writer = await connect(peer.address)
+      except OSError:
+        await asyncio.sleep(RECONNECT)
+        continue
+      try:
+        writer.write(peer.hello(self.address))
+        while True:
+          await peer.ready.wait()
+          peer.ready.clear()
+          messages = list(peer.messages)
+          peer.messages.clear()
+          writer.write(b"".join(frame(peer.encoder.encode(msg, dst))
+                                for dst, msg in messages))
+          await writer.drain()
+      except OSError:
+        # Frames written to a broken connection are lost, just like
+        # messages to a crashed process. The next connection starts
+        # with a fresh table of interned ids.
+        writer.close()
+        peer.encoder = Encoder()
+
+  async def serve(self, reader, writer):
+    try:
+      hello = await readFrame(reader)
+      if hello[0] != VERSION:
+        raise ValueError("peer speaks wire format version %d" % hello[0])
+      address = parseAddress(hello[1:].decode())
+      decoder = Decoder()
+      while True:
+        dst, msg = decoder.decode(await readFrame(reader), True)
+        if msg.src not in self.env.procs:
+          self.routes[msg.src] = address
+        if dst in self.env.procs:
+          self.env.procs[dst].deliver(msg)
+    except (asyncio.IncompleteReadError, OSError, ValueError,
+            pickle.UnpicklingError):
+      writer.close()
+
+
+class test_transport(ut.TestCase):
+  class Node:
+    def __init__(self, address, pids):
+      self.procs = {pid: self for pid in pids}
+      self.inbox = queue.SimpleQueue()
+      self.transport = Transport(self, address)
+      self.transport.start()
+
+    def deliver(self, msg):
+      self.inbox.put(msg)
+
+  def setUp(self):
+    self.a = self.Node(("127.0.0.1", 0), ["a"])
+    self.b = self.Node(("127.0.0.1", 0), ["b"])
+    # Port 0 picks a free port; route to the one actually bound.
+    for n in (self.a, self.b):
+      n.transport.address = n.transport.server.sockets[0].getsockname()[:2]
+    self.a.transport.route("b", self.b.transport.address)
+
+  def test_send_and_reply(self):
+    for i in range(100):
+      self.a.transport.send("b", RequestMessage("a", Command("a", i, "op")))
+    received = [self.b.inbox.get(timeout=5) for i in range(100)]
+    self.assertEqual([m.command.req_id for m in received], list(range(100)))
+    # b learned the route back to a from the messages it received.
+    self.b.transport.send("a", RequestMessage("b", Command("b", 0, "op")))
+    self.assertEqual(self.a.inbox.get(timeout=5).src, "b")
+
+  def test_unix_socket(self):
+    import os, tempfile
+    path = os.path.join(tempfile.mkdtemp(), "c.sock")
+    c = self.Node(path, ["c"])
+    self.a.transport.route("c", path)
+    self.a.transport.send("c", RequestMessage("a", Command("a", 0, "op")))
+    self.assertEqual(c.inbox.get(timeout=5).src, "a")
+    c.transport.send("a", RequestMessage("c", Command("c", 0, "op")))
+    self.assertEqual(self.a.inbox.get(timeout=5).src, "c")
+    os.remove(path)
+
+  def test_unreachable_peer(self):
+    # Only the last MAXQUEUED messages wait for a peer to come up.
+    import os, tempfile
+    path = os.path.join(tempfile.mkdtemp(), "c.sock")
+    self.a.transport.route("c", path)
+    for i in range(MAXQUEUED + 10):
+      self.a.transport.send("c", RequestMessage("a", Command("a", i, "op")))
+    # Runs once the event loop has queued them.
+    flushed = threading.Event()
+    self.a.transport.loop.call_soon_threadsafe(flushed.set)
+    self.assertTrue(flushed.wait(5))
+    self.assertEqual(len(self.a.transport.peers[path].messages), MAXQUEUED)
+    c = self.Node(path, ["c"])
+    self.assertEqual(c.inbox.get(timeout=5).command.req_id, 10)
+    os.remove(path)
+
+if __name__ == "__main__":
+  ut.main()
@@ -1,11 +1,36 @@
 from collections import namedtuple
+import registry
 import unittest as ut
 WINDOW = 5
+P2ABATCH = 16         # Max. number of slots a commander sends in one p2a message
+P2ALINGER = 0.001     # Seconds a commander waits for more slots to fill a batch
+REQUESTBATCH = 100    # Max. number of client commands a replica puts in one slot
+REQUESTDELAY = 0.001  # Seconds a replica waits for more commands to fill a batch
+CHECKPOINTINTERVAL = 1000  # Number of slots between two replica checkpoints
+GROUPCOMMIT = 256     # Max. number of messages an acceptor logs with one fsync
+LEASE = 1.0           # Seconds a preempted leader waits for the active leader
+                      # to fall silent before it competes again
+HEARTBEAT = 0.1       # Seconds between two heartbeats of the active leader
+RESPONSECACHE = 1024  # Number of responses a replica keeps per client to answer
+                      # retries of commands it already performed
+CLIENTWINDOW = 100    # Max. number of requests a client has outstanding
+CLIENTTIMEOUT = 1.0   # Seconds a client waits before it retries a request
+READINDEXTIMEOUT = 1.0 # Seconds a replica waits for a read index before it
+                       # asks the leaders again
+CLOCKDRIFT = 0.1      # Fraction of a lease a leader gives up to allow for
+                      # clocks that run at different rates
+RESEND = 0.2          # Seconds after which a scout, commander or replica sends
+                      # again what was not answered, as it may have been lost
+THRIFTY = 0.05        # Seconds a scout or commander waits for the majority of
+                      # acceptors it asked before it asks the others too;
+                      # None asks all of them at once
+POOLSIZE = 4          # Max. number of threads that run the scouts and
+                      # commanders of an Env; None gives each its own
 
 class BallotNumber(namedtuple('BallotNumber',['round','leader_id'])):
   __slots__ = ()
   def __str__(self):
-    return "BN(%d,%s)" % (self.round, str(self.leader_id))
+    return "BN(%d,%s)" % (self.round, registry.name(self.leader_id))
 
   def __gt__(self, other):
     if other is None:
@@ -32,6 +57,11 @@ class Command(namedtuple('Command',['client',
                                   str(self.req_id),
                                   str(self.op))
 
+class BatchCommand(namedtuple('BatchCommand',['commands'])):
+  __slots__ = ()
+  def __str__(self):
+    return "BatchCommand(%s)" % ','.join(str(c) for c in self.commands)
+
 class ReconfigCommand(namedtuple('ReconfigCommand',['client',
                                                     'req_id',
                                                     'config'])):
@@ -46,9 +76,54 @@ class Config(namedtuple('Config',['replicas',
                                   'leaders'])):
   __slots__ = ()
   def __str__(self):
-    return "%s;%s;%s" % (','.join(self.replicas),
-                         ','.join(self.acceptors),
-                         ','.join(self.leaders))
+    return "%s;%s;%s" % (','.join(map(registry.name, self.replicas)),
+                         ','.join(map(registry.name, self.acceptors)),
+                         ','.join(map(registry.name, self.leaders)))
+
+def preferred(acceptors, turn, avoid=()):
+  """
+  Returns a majority of acceptors, rotated by turn so that their load
+  spreads over all of them, and leaving out those in avoid if there
+  are enough others.
+  """
+  n = len(acceptors)
+  rotated = [acceptors[(turn+i) % n] for i in range(n)]
+  ranked = [a for a in rotated if a not in avoid] + \
+           [a for a in rotated if a in avoid]
+  return ranked[:n//2+1]
+
+class RequestIndex:
+  """
+  The (client, req_id) pairs of the commands performed so far. Per
+  client it keeps a high-water mark below which every req_id has been
+  performed, and only the req_ids above it individually, so lookups
+  are O(1) and the index stays as small as the number of clients.
+  """
+  def __init__(self):
+    self.clients = {} # client -> [high-water mark, set of req_ids above it]
+
+  def __contains__(self, cmd):
+    if cmd.client not in self.clients:
+      return False
+    hwm, above = self.clients[cmd.client]
+    return cmd.req_id <= hwm or cmd.req_id in above
+
+  def add(self, cmd):
+    if cmd.client not in self.clients:
+      self.clients[cmd.client] = [-1, set()]
+    entry = self.clients[cmd.client]
+    if cmd.req_id <= entry[0]:
+      return
+    entry[1].add(cmd.req_id)
+    while entry[0]+1 in entry[1]:
+      entry[0] += 1
+      entry[1].remove(entry[0])
+
+  def copy(self):
+    index = RequestIndex()
+    for client, (hwm, above) in self.clients.items():
+      index.clients[client] = [hwm, set(above)]
+    return index
 
 
 class test_ballot_number(ut.TestCase):
@@ -62,6 +137,34 @@ class test_ballot_number(ut.TestCase):
     self.assertTrue(self.y > self.x)
   def test_comapre_smaller(self):
     self.assertFalse(self.x > self.y)
+
+class test_preferred(ut.TestCase):
+  def test_rotates(self):
+    acceptors = ["a", "b", "c", "d", "e"]
+    self.assertEqual(preferred(acceptors, 0), ["a", "b", "c"])
+    self.assertEqual(preferred(acceptors, 4), ["e", "a", "b"])
+
+  def test_avoids(self):
+    acceptors = ["a", "b", "c"]
+    self.assertEqual(preferred(acceptors, 0, {"a"}), ["b", "c"])
+    self.assertEqual(preferred(acceptors, 0, {"a", "b"}), ["c", "a"])
+
+class test_request_index(ut.TestCase):
+  def setUp(self):
+    self.index = RequestIndex()
+
+  def test_contains(self):
+    self.index.add(Command("a", 0, "op"))
+    self.assertTrue(Command("a", 0, "other op") in self.index)
+    self.assertFalse(Command("a", 1, "op") in self.index)
+    self.assertFalse(Command("b", 0, "op") in self.index)
+
+  def test_out_of_order(self):
+    self.index.add(Command("a", 2, "op"))
+    self.index.add(Command("a", 0, "op"))
+    self.assertFalse(Command("a", 1, "op") in self.index)
+    self.index.add(Command("a", 1, "op"))
+    self.assertEqual(self.index.clients["a"], [2, set()])
     
 if __name__ == "__main__":
   ut.main()
@@ -0,0 +1,156 @@
+import os
+import pickle
+import struct
+import tempfile
+import unittest as ut
+import zlib
+from pvalueset import PValueSet
+from utils import BallotNumber, PValue
+
+class AcceptorLog:
+  """
+  Write-ahead log of the state of an acceptor. Promises and accepted
+  pvalues are appended as they happen, and sync() makes everything
+  appended so far durable with a single fsync, so an acceptor can
+  group-commit all messages it handled before it answers any of them.
+
+  Every record is a 4-byte length, a 4-byte CRC32 and a pickled
+  payload. A record cut short by a crash fails the check and is
+  dropped, together with everything after it, on recovery.
+  """
+  HEADER = struct.Struct("!II")
+
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, "ab")
+    self.dirty = False
+
+  def recover(self):
+    """
+    Replays the log and returns the ballot number, the accepted
+    pvalues and the checkpoint it describes.
+    """
+    ballot_number, accepted, checkpoint = None, PValueSet(), 0
+    end = 0
+    with open(self.path, "rb") as f:
+      data = f.read()
+    while end + self.HEADER.size <= len(data):
+      length, crc = self.HEADER.unpack_from(data, end)
+      start = end + self.HEADER.size
+      payload = data[start:start+length]
+      if len(payload) < length or zlib.crc32(payload) != crc:
+        break
+      kind, value = pickle.loads(payload)
+      if kind == "promise":
+        ballot_number = value
+      elif kind == "accept":
+        accepted.add(value)
+      elif kind == "checkpoint":
+        checkpoint = value
+        accepted.truncate(checkpoint+1)
+      end = start + length
+    if end < len(data):
+      self.file.truncate(end)
+    return ballot_number, accepted, checkpoint
+
+  def append(self, kind, value):
+    payload = pickle.dumps((kind, value), pickle.HIGHEST_PROTOCOL)
+    self.file.write(self.HEADER.pack(len(payload), zlib.crc32(payload)))
+    self.file.write(payload)
+    self.dirty = True
+
+  def promise(self, ballot_number):
+    self.append("promise", ballot_number)
+
+  def accept(self, pvalue):
+    self.append("accept", pvalue)
+
+  def sync(self):
+    if self.dirty:
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self.dirty = False
+
+  def rewrite(self, ballot_number, accepted, checkpoint):
+    """
+    Replaces the log by a fresh one holding only the given state, so
+    the log shrinks along with the acceptor after a checkpoint.
+    """
+    self.sync()
+    self.file.close()
+    tmp = self.path + ".tmp"
+    self.file = open(tmp, "wb")
+    self.append("checkpoint", checkpoint)
+    if ballot_number is not None:
+      self.promise(ballot_number)
+    for pvalue in accepted:
+      self.accept(pvalue)
+    self.sync()
+    self.file.close()
+    os.replace(tmp, self.path)
+    fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+    self.file = open(self.path, "ab")
+
+  def close(self):
+    self.sync()
+    self.file.close()
+
+
+class test_acceptor_log(ut.TestCase):
+  def setUp(self):
+    # Cleanups run last first, so the logs are closed before their
+    # directory goes.
+    self.dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.dir.cleanup)
+    self.path = os.path.join(self.dir.name, "acceptor.wal")
+    self.ballot_number = BallotNumber(1, "leader 0")
+
+  def open(self):
+    log = AcceptorLog(self.path)
+    self.addCleanup(log.close)
+    return log
+
+  def test_recover(self):
+    log = self.open()
+    log.promise(self.ballot_number)
+    for s in range(1, 4):
+      log.accept(PValue(self.ballot_number, s, "op %d" % s))
+    log.sync()
+    ballot_number, accepted, checkpoint = self.open().recover()
+    self.assertEqual(ballot_number, self.ballot_number)
+    self.assertEqual(len(accepted), 3)
+    self.assertEqual(checkpoint, 0)
+
+  def test_torn_record(self):
+    log = self.open()
+    log.promise(self.ballot_number)
+    log.accept(PValue(self.ballot_number, 1, "op 1"))
+    log.sync()
+    size = os.path.getsize(self.path)
+    with open(self.path, "ab") as f:
+      f.write(b"\x00\x00\x01\x00garbage")
+    ballot_number, accepted, checkpoint = self.open().recover()
+    self.assertEqual(len(accepted), 1)
+    self.assertEqual(os.path.getsize(self.path), size)
+
+  def test_rewrite(self):
+    log = self.open()
+    log.promise(self.ballot_number)
+    for s in range(1, 11):
+      log.accept(PValue(self.ballot_number, s, "op %d" % s))
+    accepted = PValueSet(PValue(self.ballot_number, s, "op %d" % s)
+                         for s in range(6, 11))
+    log.rewrite(self.ballot_number, accepted, 5)
+    log.accept(PValue(self.ballot_number, 11, "op 11"))
+    log.sync()
+    ballot_number, accepted, checkpoint = self.open().recover()
+    self.assertEqual(checkpoint, 5)
+    self.assertEqual(sorted(pv.slot_number for pv in accepted),
+                     list(range(6, 12)))
+
+if __name__ == "__main__":
+  ut.main()
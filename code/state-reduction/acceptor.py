@@ -19,7 +19,9 @@ class Acceptor(Process):
       if isinstance(msg, P1aMessage):
         if (self.ballot_number == None or msg.ballot_number > self.ballot_number):
           self.ballot_number = msg.ballot_number
-        self.sendMessage(msg.src, P1bMessage(self.me, self.ballot_number, self.accepted))
+        # Send a copy: the scout reads it while this acceptor keeps
+        # accepting.
+        self.sendMessage(msg.src, P1bMessage(self.me, self.ballot_number, self.accepted.range(1)))
       elif isinstance(msg, P2aMessage):
         if (self.ballot_number == None or msg.ballot_number >= self.ballot_number):
           self.ballot_number = msg.ballot_number
@@ -34,8 +34,8 @@ class Leader(Process):
                                   self.ballot_number, msg.slot_number, msg.command)
             elif isinstance(msg, AdoptedMessage):
                 if self.ballot_number == msg.ballot_number:
-                    for slot_number in msg.accepted.pvalues:
-                        self.proposals[slot_number] = msg.accepted.pvalues[slot_number].command
+                    for pv in msg.accepted:
+                        self.proposals[pv.slot_number] = pv.command
                     for sn in self.proposals:
                         Commander(self.env,
                                   "commander:%s:%s:%s" % (str(self.me),
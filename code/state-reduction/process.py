@@ -1,10 +1,23 @@
 import multiprocessing
+import queue
 from threading import Thread
 
+def local_inbox():
+  return queue.SimpleQueue()
+
+def manager_inbox():
+  return multiprocessing.Manager().Queue()
+
 class Process(Thread):
+  # Backend for the incoming message queue of every process. The
+  # in-process queue is the default; switch to manager_inbox only when
+  # messages have to cross OS process boundaries, since it starts a
+  # Manager server per process and pickles every message.
+  inbox_factory = staticmethod(local_inbox)
+
   def __init__(self):
     super(Process, self).__init__()
-    self.inbox = multiprocessing.Manager().Queue()
+    self.inbox = self.inbox_factory()
 
   def run(self):
     try:
@@ -2,20 +2,33 @@ from utils import PValue
 
 class PValueSet:
     """PValueSet encloses a set of pvalues with the highest ballotnumber
-    (always) and supports corresponding set functions.
+    (always) and supports corresponding set functions. It keeps at most
+    one pvalue per slot_number, so its size is bounded by the number of
+    slots rather than by the number of pvalues ever accepted.
     """
-    def __init__(self):
+    __slots__ = ('pvalues', 'low', 'high')
+
+    def __init__(self, pvalues=()):
         self.pvalues = {} # indexed by slot_number: pvalue
+        self.low = 1      # no slot_number below low is in the set
+        self.high = 0     # no slot_number above high is in the set
+        for pvalue in pvalues:
+            self.add(pvalue)
 
     def add(self, pvalue):
         """Adds given PValue to the PValueSet overwriting matching
         (commandnumber,proposal) if it exists and has a smaller ballotnumber
         """
-        if self.pvalues.has_key(pvalue.slot_number):
-            if self.pvalues[pvalue.slot_number].ballot_number < pvalue.ballot_number:
-                self.pvalues[pvalue.slot_number] = pvalue
-        else:
-            self.pvalues[pvalue.slot_number] = pvalue
+        slot_number = pvalue.slot_number
+        if slot_number < self.low:
+            return
+        current = self.pvalues.get(slot_number)
+        if current is None:
+            self.pvalues[slot_number] = pvalue
+            if slot_number > self.high:
+                self.high = slot_number
+        elif current.ballot_number < pvalue.ballot_number:
+            self.pvalues[slot_number] = pvalue
 
     def remove(self, pvalue):
         """Removes given pvalue"""
@@ -23,15 +36,49 @@ class PValueSet:
 
     def update(self, given_pvalueset):
         """Updates the pvalues of given_pvalueset with the pvalues of the
-        pvalueset overwriting the slot_numbers with lower ballotnumber
+        pvalueset overwriting the slot_numbers with lower ballotnumber.
+        Takes time linear in the size of given_pvalueset.
         """
-        for candidate in given_pvalueset.pvalues.itervalues():
+        for candidate in given_pvalueset.pvalues.values():
             self.add(candidate)
 
+    def slots(self, start, end):
+        """Returns the slot_numbers in [start, end) that are in the set,
+        walking whichever is smaller: the range or the set.
+        """
+        start = max(start, self.low)
+        end = min(end, self.high+1)
+        if end - start <= len(self.pvalues):
+            return [s for s in range(start, end) if s in self.pvalues]
+        return [s for s in self.pvalues if start <= s < end]
+
+    def range(self, start, end=None):
+        """Returns a new PValueSet with the pvalues for slot_numbers in
+        [start, end), or from start on if end is None
+        """
+        if end is None:
+            end = self.high+1
+        result = PValueSet()
+        for s in self.slots(start, end):
+            result.add(self.pvalues[s])
+        return result
+
+    def truncate(self, slot_number):
+        """Removes all pvalues below slot_number and ignores any pvalue
+        for those slot_numbers that is added later on
+        """
+        for s in self.slots(self.low, slot_number):
+            del self.pvalues[s]
+        self.low = max(self.low, slot_number)
+
+    def __iter__(self):
+        """Iterates over the PValues in the PValueSet"""
+        return iter(self.pvalues.values())
+
     def __len__(self):
         """Returns the number of PValues in the PValueSet"""
         return len(self.pvalues)
 
     def __str__(self):
         """Returns PValueSet information"""
-        return "\n".join(str(pvalue) for pvalue in self.pvalues.itervalues())
+        return "\n".join(str(pvalue) for pvalue in self.pvalues.values())
@@ -25,12 +25,12 @@ class Scout(Process):
         if self.ballot_number == msg.ballot_number and msg.src in waitfor:
           pvalues.update(msg.accepted)
           waitfor.remove(msg.src)
-          if (2 * len(waitfor)) > len(self.acceptors):
+          if (2 * len(waitfor)) < len(self.acceptors):
             self.sendMessage(self.leader, AdoptedMessage(self.me, self.ballot_number, pvalues))
             return
-          else:
-            self.sendMessage(self.leader, PreemptedMessage(self.me, msg.ballot_number))
-            return
-        else:
-          print("Scout: unexpected msg")
+        elif self.ballot_number != msg.ballot_number:
+          self.sendMessage(self.leader, PreemptedMessage(self.me, msg.ballot_number))
+          return
+      else:
+        print("Scout: unexpected msg")
 